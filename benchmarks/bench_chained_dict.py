@@ -0,0 +1,48 @@
+"""Session lookups through deeply nested frames: hits in the root frame,
+misses, the cost of extending a frame that has its own items, and of
+nesting using(data) blocks."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import timeit
+
+from voom.context import CactusStack, ChainedDict, SessionKeys
+
+
+def chain(depth):
+    d = ChainedDict({SessionKeys.REPLY_TO: "thread+current:"})
+    for i in xrange(depth):
+        d = d.extend()
+        d[i] = i
+    return d
+
+
+def nest(depth):
+    """Enter depth nested push_frame(data=...) blocks, as using() does."""
+    stack = CactusStack()
+    blocks = []
+    for i in xrange(depth):
+        block = stack.push_frame(data={i: i})
+        block.__enter__()
+        blocks.append(block)
+    for block in reversed(blocks):
+        block.__exit__(None, None, None)
+
+
+def report(label, stmt, number=10000):
+    elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+    print "%-28s %8.3f usec" % (label, elapsed / number * 1e6)
+
+
+def main():
+    for depth in (1, 10, 100, 1000):
+        d = chain(depth)
+        report("depth %4d: root hit" % depth, lambda: d.get(SessionKeys.REPLY_TO))
+        report("depth %4d: miss" % depth, lambda: d.get('missing'))
+        report("depth %4d: extend" % depth, lambda: d.extend())
+    for depth in (1000, 2000, 4000):
+        report("using nested %4d deep" % depth, lambda: nest(depth), number=3)
+
+
+if __name__ == "__main__":
+    main()
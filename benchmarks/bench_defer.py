@@ -0,0 +1,41 @@
+"""Measures handlers that each defer ten thousand messages, from the call to
+defer() until every deferred message has been handled."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import time
+
+from voom.bus import VoomBus
+
+DEFERRED = 10000
+
+
+def bench(handlers, repeat=5):
+    bus = VoomBus()
+
+    def fan_out(msg):
+        for i in xrange(DEFERRED):
+            bus.defer(i)
+    for _ in xrange(handlers):
+        # distinct callbacks, as subscribing one twice is a no-op
+        bus.subscribe(str, lambda msg: fan_out(msg))
+    bus.subscribe(int, lambda msg: None)
+
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        bus.publish("go")
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    total = DEFERRED * handlers
+    print "%2d handlers %8d deferred  %8.1fms  %6.2f usec/message" % (
+        handlers, total, best * 1000, best / total * 1e6)
+
+
+def main():
+    for handlers in (1, 4, 10):
+        bench(handlers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Times finding the handlers modules of a large synthetic INSTALLED_APPS,
+probing every app against using a warm FinderCache."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import shutil
+import tempfile
+import timeit
+
+from voom.adaptors.django.discover import FinderCache, find_related_module
+
+APPS = 1000
+PATH_ENTRIES = 20
+
+
+def make_apps(root):
+    apps = []
+    for i in range(APPS):
+        name = "benchapp%04d" % i
+        package = os.path.join(root, name)
+        os.mkdir(package)
+        open(os.path.join(package, "__init__.py"), "w").close()
+        if i % 4 == 0:
+            open(os.path.join(package, "handlers.py"), "w").close()
+        apps.append(name)
+    return apps
+
+
+def main():
+    root = tempfile.mkdtemp()
+    # pad sys.path, as a large deployment would.
+    padding = [tempfile.mkdtemp() for _ in range(PATH_ENTRIES)]
+    sys.path[:0] = padding + [root]
+    try:
+        apps = make_apps(root)
+        cache_path = os.path.join(root, "discovery.json")
+
+        def discover(cache_path=None):
+            cache = FinderCache(cache_path) if cache_path else None
+            modules = filter(None, [find_related_module(app, "handlers", cache) for app in apps])
+            if cache is not None:
+                cache.save()
+            return modules
+
+        # the first pass pays for importing everything.
+        found = len(discover(cache_path))
+        probe = min(timeit.repeat(discover, number=1, repeat=5))
+        cached = min(timeit.repeat(lambda: discover(cache_path), number=1, repeat=5))
+        print "%d apps, %d with handlers" % (APPS, found)
+        print "%-12s %8.2fms" % ("probing", probe * 1000)
+        print "%-12s %8.2fms" % ("cached", cached * 1000)
+    finally:
+        for d in padding + [root]:
+            sys.path.remove(d)
+            shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main()
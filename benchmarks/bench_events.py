@@ -0,0 +1,36 @@
+"""Construction time, equality and memory per instance of the slotted
+classes generated by Event.new, against a plain Event subclass (the
+layout Event.new generated before)."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import timeit
+
+from voom.events.base import Event
+
+Slotted = Event.new("Slotted", "user thing when")
+
+
+class Legacy(Event):
+    FIELDS = ["user", "thing", "when"]
+
+
+def size(obj):
+    total = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        total += sys.getsizeof(obj.__dict__)
+    return total
+
+
+def main():
+    for klass in (Legacy, Slotted):
+        name = klass.__name__
+        setup = "from __main__ import %s; a = %s('bob', 'login', 1); b = %s('bob', 'login', 1)" % (name, name, name)
+        construct = min(timeit.repeat("%s('bob', 'login', 1)" % name, setup, number=100000, repeat=3))
+        eq = min(timeit.repeat("a == b", setup, number=100000, repeat=3))
+        print "%-8s construct %6.3f usec  eq %6.3f usec  %4d bytes/instance" % (
+            name, construct * 10, eq * 10, size(klass('bob', 'login', 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compares throughput of a CPU bound handler run inline against the same
+handler offloaded to a process pool. Several publisher threads compete for
+the GIL; run on a multi-core box to see the difference."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import time
+
+from voom.bus import VoomBus
+from voom.decorators import receiver
+from voom.events.base import Event
+
+Render = Event.new("Render", "size")
+
+N = 64
+WORK = 200000
+
+bus = VoomBus()
+
+
+def crunch(size):
+    total = 0
+    for i in xrange(size):
+        total += i * i
+    return total
+
+
+@receiver(Render)
+def inline(msg):
+    crunch(msg.size)
+
+
+@receiver(Render, process=True)
+def offloaded(msg):
+    crunch(msg.size)
+
+
+def run(threads):
+    per_thread = N // threads
+
+    def publisher():
+        for _ in xrange(per_thread):
+            bus.publish(Render(WORK))
+
+    workers = [threading.Thread(target=publisher) for _ in xrange(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return per_thread * threads / (time.time() - start)
+
+
+def main():
+    cpus = multiprocessing.cpu_count()
+    bus.register(inline)
+    print "cpus: %d, messages: %d" % (cpus, N)
+    print "%-10s %8.1f msg/s" % ("inline", run(cpus))
+
+    bus.resetConfig()
+    bus.register(offloaded)
+    bus.process_executor = pool = ProcessPoolExecutor(cpus)
+    try:
+        print "%-10s %8.1f msg/s" % ("process", run(cpus))
+    finally:
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Compares publishing a batch of bodies one at a time against publish_many."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import time
+
+from voom.bus import VoomBus
+
+N = 100000
+
+
+def noop(msg):
+    pass
+
+
+def bench(label, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print "%-24s %8.3fs  %6.2f usec/msg" % (label, elapsed, elapsed / N * 1e6)
+    return elapsed
+
+
+def main():
+    bus = VoomBus()
+    bus.subscribe(int, noop)
+    bodies = range(N)
+
+    def sequential():
+        for body in bodies:
+            bus.publish(body)
+
+    def batched():
+        bus.publish_many(bodies)
+
+    seq = bench("publish() loop", sequential)
+    many = bench("publish_many()", batched)
+    print "saved %.2f usec/msg (%.1fx)" % ((seq - many) / N * 1e6, seq / many)
+
+
+if __name__ == "__main__":
+    main()
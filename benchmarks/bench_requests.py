@@ -0,0 +1,37 @@
+"""Measures the cost of tracking many in-flight requests: opening them with a
+timeout, answering them later, and letting them expire."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import time
+
+from voom.bus import VoomBus
+
+N = 50000
+
+
+def main():
+    bus = VoomBus()
+    contexts = []
+    bus.subscribe(int, lambda n: contexts.append(bus.get_reply_context()))
+
+    start = time.time()
+    futures = [bus.request(i, timeout=60) for i in xrange(N)]
+    opened = time.time() - start
+    print "%-10s %6d in flight  %6.2f usec/request" % ("request", len(bus._pending_replies), opened / N * 1e6)
+
+    start = time.time()
+    for i, context in enumerate(contexts):
+        bus.reply(i, context)
+    replied = time.time() - start
+    assert all(f.done() for f in futures)
+    print "%-10s %6d in flight  %6.2f usec/reply" % ("reply", len(bus._pending_replies), replied / N * 1e6)
+
+    futures = [bus.request(i, timeout=0.05) for i in xrange(N)]
+    start = time.time()
+    futures[-1].exception()
+    print "%-10s %6d in flight  %6.3fs to expire all" % ("expire", len(bus._pending_replies), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measures scheduling, cancelling and expiring a million timers on the
+hierarchical timing wheel, and delivering scheduled messages through a bus."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import random
+import threading
+import time
+
+from voom.bus import VoomBus
+from voom.timers import HierarchicalTimerWheel
+
+TIMERS = 1000000
+MESSAGES = 100000
+
+
+def bench_wheel():
+    wheel = HierarchicalTimerWheel(now=0)
+    rnd = random.Random(1)
+    deadlines = [rnd.uniform(0, 3600) for _ in xrange(TIMERS)]
+
+    start = time.time()
+    timers = [wheel.schedule(d, None) for d in deadlines]
+    elapsed = time.time() - start
+    print "%-10s %8d timers  %6.2f usec/timer" % ("schedule", len(wheel), elapsed / TIMERS * 1e6)
+
+    start = time.time()
+    for timer in timers[::2]:
+        wheel.cancel(timer)
+    elapsed = time.time() - start
+    print "%-10s %8d timers  %6.2f usec/timer" % ("cancel", len(wheel), elapsed / (TIMERS / 2) * 1e6)
+
+    # an hour of ticks, as the scheduler thread would advance them
+    start = time.time()
+    expired = 0
+    for now in xrange(1, 3601):
+        for tick in xrange(100):
+            expired += len(wheel.advance(now - 1 + (tick + 1) * 0.01))
+    elapsed = time.time() - start
+    print "%-10s %8d timers  %6.2f usec/timer, %.2fs for 360000 ticks" % (
+        "expire", expired, elapsed / expired * 1e6, elapsed)
+
+
+def bench_bus():
+    bus = VoomBus()
+    done = threading.Event()
+    count = [0]
+
+    def receive(n):
+        count[0] += 1
+        if count[0] == MESSAGES:
+            done.set()
+    bus.subscribe(int, receive)
+
+    start = time.time()
+    when = time.time() + 0.5
+    for i in xrange(MESSAGES):
+        bus.publish_at(i, when)
+    elapsed = time.time() - start
+    print "%-10s %8d messages  %6.2f usec/message" % ("publish_at", MESSAGES, elapsed / MESSAGES * 1e6)
+    done.wait(60)
+    print "%-10s %8d messages  %.3fs after they fell due" % ("delivered", count[0], time.time() - when)
+
+
+def main():
+    bench_wheel()
+    bench_bus()
+
+
+if __name__ == "__main__":
+    main()
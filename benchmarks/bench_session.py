@@ -0,0 +1,47 @@
+"""Fixed per-message cost of the bus, and the session frame machinery it
+relies on: pushing frames with using(), and session lookups through a
+stack of nested frames."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import timeit
+
+from voom.bus import VoomBus
+
+bus = VoomBus()
+bus.subscribe(int, lambda msg: None)
+
+DEPTH = 10
+
+
+def nested(depth, fn):
+    if not depth:
+        return fn()
+    with bus.using({depth: depth}):
+        return nested(depth - 1, fn)
+
+
+def report(label, stmt, number=100000):
+    elapsed = min(timeit.repeat(stmt, number=number, repeat=3))
+    print "%-32s %8.3f usec" % (label, elapsed / number * 1e6)
+
+
+def main():
+    report("publish, 1 handler", lambda: bus.publish(1))
+
+    def using():
+        with bus.using({'a': 1}):
+            pass
+    report("using()", using)
+    report("session access", lambda: bus.session)
+
+    def lookups():
+        session = bus.session
+        report("get(), hit at depth %d" % DEPTH, lambda: session.get(DEPTH))
+        report("get(), miss at depth %d" % DEPTH, lambda: session.get('missing'))
+        report("in, miss at depth %d" % DEPTH, lambda: 'missing' in session)
+    nested(DEPTH, lookups)
+
+
+if __name__ == "__main__":
+    main()
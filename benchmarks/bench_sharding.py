@@ -0,0 +1,44 @@
+"""Shows throughput scaling with the number of shards when handlers wait on
+I/O, simulated with a 1ms sleep per message."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import time
+from operator import itemgetter
+
+from voom.bus import VoomBus
+from voom.sharding import ShardedDispatcher
+
+N = 2000
+KEYS = 500
+
+
+def io_bound(msg):
+    time.sleep(0.001)
+
+
+def run(shards):
+    bus = VoomBus()
+    bus.subscribe(tuple, io_bound)
+    dispatcher = ShardedDispatcher(bus, key=itemgetter(0), shards=shards)
+    start = time.time()
+    for i in xrange(N):
+        dispatcher.publish((i % KEYS, i))
+    dispatcher.close()
+    return N / (time.time() - start)
+
+
+def main():
+    start = time.time()
+    bus = VoomBus()
+    bus.subscribe(tuple, io_bound)
+    bus.publish_many((i % KEYS, i) for i in xrange(N))
+    serial = N / (time.time() - start)
+    print "%-10s %8.0f msg/s" % ("serial", serial)
+    for shards in (1, 2, 4, 8, 16, 32):
+        rate = run(shards)
+        print "%-10s %8.0f msg/s  %5.1fx" % ("shards=%d" % shards, rate, rate / serial)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measures throughput and round-trip latency of buses bridged through a LocalBroker."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import shutil
+import tempfile
+import threading
+import time
+
+from voom.bus import VoomBus
+from voom.events.base import Event
+from voom.transport import LocalBroker, BusBridge
+
+Ping = Event.new("Ping", "n")
+Pong = Event.new("Pong", "n")
+
+N = 50000
+ROUND_TRIPS = 2000
+
+
+def throughput(path):
+    sender, receiver = VoomBus(), VoomBus()
+    done = threading.Event()
+    count = [0]
+
+    def received(msg):
+        count[0] += 1
+        if count[0] == N:
+            done.set()
+    receiver.subscribe(Ping, received)
+    bridges = [BusBridge(sender, path, [Ping]), BusBridge(receiver, path)]
+    time.sleep(0.1)
+
+    start = time.time()
+    sender.publish_many(Ping(i) for i in xrange(N))
+    done.wait(60)
+    elapsed = time.time() - start
+    print "throughput: %d msgs in %.3fs, %.0f msgs/sec" % (count[0], elapsed, count[0] / elapsed)
+    for bridge in bridges:
+        bridge.close()
+
+
+def latency(path):
+    client, server = VoomBus(), VoomBus()
+    server.subscribe(Ping, lambda msg: server.publish(Pong(msg.n)))
+    pong = threading.Event()
+    client.subscribe(Pong, lambda msg: pong.set())
+    bridges = [BusBridge(client, path, [Ping]), BusBridge(server, path, [Pong])]
+    time.sleep(0.1)
+
+    samples = []
+    for i in xrange(ROUND_TRIPS):
+        pong.clear()
+        start = time.time()
+        client.publish(Ping(i))
+        pong.wait(5)
+        samples.append(time.time() - start)
+    samples.sort()
+    print "round trip: median %.1f usec, p99 %.1f usec" % (samples[len(samples) // 2] * 1e6,
+                                                          samples[int(len(samples) * 0.99)] * 1e6)
+    for bridge in bridges:
+        bridge.close()
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    broker = LocalBroker(os.path.join(tmp, "voom.sock"))
+    try:
+        throughput(broker.path)
+        latency(broker.path)
+    finally:
+        broker.close()
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
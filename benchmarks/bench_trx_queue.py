@@ -0,0 +1,57 @@
+"""Measures a transaction's queue under large fan-outs: enqueueing a hundred
+thousand messages over the BusPriority levels and consuming them, against a
+heap of (rank, sequence, message) as a baseline."""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import heapq
+import itertools
+import random
+import time
+
+from voom.context import MessageEnvelope, TrxState
+from voom.priorities import BusPriority
+
+MESSAGES = 100000
+
+LEVELS = [None, BusPriority.LOW_PRIORITY, BusPriority.MEDIUM_PRIORITY, BusPriority.HIGH_PRIORITY, 0]
+
+
+def heap_queue(items):
+    heap = []
+    seq = itertools.count()
+    indx = itertools.count(2)
+    for priority, message in items:
+        heapq.heappush(heap, (next(indx) if priority is None else priority,
+                              next(seq), message))
+    while heap:
+        heapq.heappop(heap)
+
+
+def trx_queue(items):
+    s = TrxState()
+    for priority, message in items:
+        s.enqueue(message, priority)
+    for _ in s.consume_messages():
+        pass
+
+
+def main():
+    rnd = random.Random(1)
+    envelopes = [MessageEnvelope(i, None) for i in xrange(MESSAGES)]
+    workloads = [("single", [(None, e) for e in envelopes]),
+                 ("mixed", [(rnd.choice(LEVELS), e) for e in envelopes])]
+    for name, items in workloads:
+        for label, fn in (("heapq", heap_queue), ("TrxState", trx_queue)):
+            best = None
+            for _ in xrange(5):
+                start = time.time()
+                fn(items)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print "%-8s %-10s %8d messages  %6.3f usec/message" % (
+                name, label, MESSAGES, best / MESSAGES * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Benchmarks the bus hot paths, writing the results as JSON so that runs can
+be compared between commits.
+
+    python benchmarks/run.py -o before.json
+    git checkout topic
+    python benchmarks/run.py --compare before.json
+
+With --compare, the run exits with status 1 when any benchmark is slower
+than the baseline by more than --threshold percent.
+"""
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..")) # make this file executable
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import timeit
+
+from voom.bus import VoomBus
+from voom.context import ChainedDict, MessageEnvelope, TrxState
+from voom.events.base import Event
+
+Order = Event.new("Order", "id customer status total region")
+
+BENCHMARKS = []
+
+
+def benchmark(name, number):
+    """Register a benchmark. The decorated function sets it up and returns the
+    callable that is timed, number times per repeat; results are per call."""
+    def register(setup):
+        BENCHMARKS.append((name, number, setup))
+        return setup
+    return register
+
+
+def noop(msg):
+    pass
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+
+def publish_with(handlers):
+    def setup():
+        bus = VoomBus()
+        for _ in range(handlers):
+            bus.subscribe(int, lambda msg: None)
+        return lambda: bus.publish(1)
+    return setup
+
+
+for _handlers, _number in ((0, 20000), (1, 20000), (10, 10000), (100, 2000)):
+    benchmark("publish/handlers=%d" % _handlers, _number)(publish_with(_handlers))
+
+
+@benchmark("publish_many/batch=100", 500)
+def publish_many():
+    bus = VoomBus()
+    bus.subscribe(int, noop)
+    bodies = range(100)
+    return lambda: bus.publish_many(bodies)
+
+
+@benchmark("transaction/nested=3", 5000)
+def nested_transactions():
+    bus = VoomBus()
+    bus.subscribe(int, noop)
+
+    def run():
+        with bus.transaction():
+            bus.publish(1)
+            with bus.transaction():
+                bus.publish(2)
+                with bus.transaction():
+                    bus.publish(3)
+    return run
+
+
+@benchmark("defer/chain=100", 200)
+def deferred_chain():
+    bus = VoomBus()
+
+    def next_link(n):
+        if n:
+            bus.defer(n - 1)
+    bus.subscribe(int, next_link)
+    return lambda: bus.publish(100)
+
+
+@benchmark("defer/fan_out=10000", 5)
+def deferred_fan_out():
+    bus = VoomBus()
+
+    def fan_out(msg):
+        for i in xrange(10000):
+            bus.defer(i)
+    bus.subscribe(str, fan_out)
+    bus.subscribe(int, noop)
+    return lambda: bus.publish("go")
+
+
+@benchmark("errors/storm=100", 100)
+def error_storm():
+    bus = VoomBus()
+    bus.subscribe(int, fail)
+    bus.subscribe(bus.ERRORS, noop)
+    bodies = range(100)
+    # keep the failures out of the output
+    logging.getLogger("voom.bus").disabled = True
+    return lambda: bus.publish_many(bodies)
+
+
+@benchmark("using/depth=100", 200)
+def deep_using():
+    bus = VoomBus()
+    bus.subscribe(int, lambda msg: bus.session.get('k0'))
+
+    def nest(depth):
+        if depth:
+            with bus.using({'k%d' % depth: depth}):
+                nest(depth - 1)
+        else:
+            bus.publish(1)
+    return lambda: nest(100)
+
+
+@benchmark("trx/enqueue_consume=1000", 200)
+def enqueue_consume():
+    envelopes = [MessageEnvelope(i, None) for i in range(1000)]
+
+    def run():
+        s = TrxState()
+        for envelope in envelopes:
+            s.enqueue(envelope)
+        for _ in s.consume_messages():
+            pass
+    return run
+
+
+@benchmark("chained_dict/lookup_depth=50", 100000)
+def chained_dict_lookup():
+    d = ChainedDict(root=1)
+    for i in range(50):
+        d = d.extend()
+        d[i] = i
+    return lambda: d['root']
+
+
+@benchmark("events/construct", 200000)
+def event_construct():
+    return lambda: Order(1, "c", "open", 10.0, "eu")
+
+
+@benchmark("events/eq_hash", 200000)
+def event_eq_hash():
+    a, b = Order(1, "c", "open", 10.0, "eu"), Order(1, "c", "open", 10.0, "eu")
+    return lambda: a == b and hash(a)
+
+
+def run(names=None, repeat=5):
+    results = {}
+    for name, number, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        fn = setup()
+        fn()  # warm up plans and caches
+        times = sorted(timeit.repeat(fn, number=number, repeat=repeat))
+        results[name] = dict(usec=times[0] / number * 1e6,
+                             median_usec=times[len(times) // 2] / number * 1e6,
+                             number=number,
+                             repeat=repeat)
+        print "%-32s %12.3f usec" % (name, results[name]['usec'])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the change against the baseline; returns the regressed benchmarks."""
+    regressions = []
+    print
+    print "%-32s %12s %12s %8s" % ("benchmark", "baseline", "current", "change")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['usec'], results[name]['usec']
+        change = (after - before) / before * 100
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSED"
+        print "%-32s %12.3f %12.3f %+7.1f%%%s" % (name, before, after, change, flag)
+    return regressions
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="a results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent slowdown counted as a regression (default: 10)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose names contain one of these")
+    args = parser.parse_args()
+
+    results = run(args.names, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(commit=_commit(),
+                           python=platform.python_version(),
+                           platform=platform.platform(),
+                           results=results), f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
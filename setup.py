@@ -35,7 +35,7 @@ except:
 
 
 if "nosetests" in sys.argv or "test" in sys.argv:
-    TEST_REQS = ['nose>=1.0', 'coverage', 'nosexcover', 'mock']
+    TEST_REQS = ['nose>=1.0', 'coverage', 'nosexcover', 'mock', 'gevent', 'futures']
 else:
     TEST_REQS = []
 
@@ -1,4 +1,6 @@
+import pickle
 from voom.events.base import Event
+import nose.tools
 import unittest
 
 
@@ -13,3 +15,82 @@ class Test(unittest.TestCase):
         assert i != 1
         assert i == klass(1, 2, 3)
         assert i != klass(1, 2, 4)
+
+    def test_pickle(self):
+        i = Picklable(1, 2)
+        assert Picklable.__module__ == __name__
+        assert pickle.loads(pickle.dumps(i, pickle.HIGHEST_PROTOCOL)) == i
+
+
+Picklable = Event.new("Picklable", "a b")
+
+
+class TestSlotted(unittest.TestCase):
+    def test_slots(self):
+        klass = Event.new("EV", "a b")
+        i = klass(1, b=2)
+        assert not hasattr(i, '__dict__')
+        assert (i.a, i.b) == (1, 2)
+        with nose.tools.assert_raises(AttributeError): #@UndefinedVariable
+            i.c = 3
+
+    def test_defaults(self):
+        klass = Event.new("EV", "a b c", b=2, c=None, kind="ev")
+        i = klass(1)
+        assert (i.a, i.b, i.c) == (1, 2, None)
+        assert klass(1, c=3).c == 3
+        assert klass.kind == "ev"
+        # like Event(*args), missing fields are None
+        i = klass()
+        assert (i.a, i.b, i.c) == (None, 2, None)
+        i = Event.new("EV", "a b", a=1)(b=3)
+        assert (i.a, i.b) == (1, 3)
+
+    def test_hash(self):
+        klass = Event.new("EV", "a b")
+        i = klass(1, ["x"])
+        assert len(set([i, i, klass(1, ["x"])])) == 2
+        assert {i: 1}[i] == 1
+        assert repr(klass(1, "x")) == "EV(a=1, b='x')"
+
+    def test_value_hash(self):
+        klass = Event.new("EV", "a b", value_hash=True)
+        assert hash(klass(1, 2)) == hash(klass(1, 2))
+        assert len(set([klass(1, 2), klass(1, 2), klass(2, 1)])) == 2
+        sub = klass.new("SubEV", "a b c")
+        assert hash(sub(1, 2, 3)) == hash(sub(1, 2, 3))
+
+    def test_subclasses(self):
+        klass = Event.new("EV", "a")
+        sub = klass.new("SubEV", "a b")
+        assert sub.__slots__ == ('b',)
+        assert sub(1, 2) == sub(1, 2)
+        assert repr(sub(1, 2)) == "SubEV(a=1, b=2)"
+
+        class Legacy(Event):
+            FIELDS = ["a", "b"]
+
+        i = Legacy(1, 2)
+        i.extra = True
+        assert i == Legacy(1, 2)
+        assert repr(i) == "Legacy(a=1, b=2)"
+
+        class Extended(klass):
+            def double(self):
+                return self.a * 2
+
+        assert Extended(2).double() == 4
+
+    def test_field_names(self):
+        klass = Event.new("Mail", "from to print self", to="me")
+        i = klass("you")
+        assert (getattr(i, "from"), i.to, getattr(i, "print"), i.self) == ("you", "me", None, None)
+        assert klass("you", "me") == klass(**{"from": "you"})
+        assert repr(i) == "Mail(from='you', to='me', print=None, self=None)"
+        with nose.tools.assert_raises(TypeError): #@UndefinedVariable
+            klass(1, 2, 3, 4, 5)
+        with nose.tools.assert_raises(TypeError): #@UndefinedVariable
+            klass(1, **{"from": 2})
+
+        i = Event.new("EV", "a-b c")(1, 2)
+        assert (getattr(i, "a-b"), i.c) == (1, 2)
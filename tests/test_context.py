@@ -1,7 +1,10 @@
 from voom.bus import VoomBus, BusPriority
-from voom.context import TrxState, ChainedDict
+from voom.context import TrxState, ChainedDict, TrxLocal, CactusStack, QueueLimits, \
+    MessageEnvelope
 from voom.decorators import receiver
-from voom.exceptions import AbortProcessing
+from voom.exceptions import AbortProcessing, QueueFull
+import nose.tools
+import pickle
 import unittest
 
 
@@ -66,6 +69,110 @@ class TestState(unittest.TestCase):
             m += _m
         assert m == "!ba"
 
+    def test_ties_keep_queued_order(self):
+        # equal priorities never compare the messages themselves
+        s = TrxState()
+        messages = [{'n': i} for i in range(5)] + [set([i]) for i in range(5)]
+        for m in messages:
+            s.enqueue(m, priority=BusPriority.DEFAULT_PRIORITY)
+        s.enqueue(1, priority=BusPriority.HIGH_PRIORITY)
+        assert s.pending() == [1] + messages
+        assert list(s.consume_messages()) == [1] + messages
+        assert s.is_queue_empty()
+
+    def test_unprioritized_lane(self):
+        # messages without a priority rank by the order they were queued in
+        s = TrxState()
+        s.enqueue("a")
+        s.enqueue("!", priority=BusPriority.HIGH_PRIORITY)
+        s.enqueue("b")
+        s.enqueue_many("cd")
+        s.enqueue("0", priority=0)
+        assert s.size() == 6
+        assert s.pending() == list("0abcd!")
+        assert "".join(s.consume_messages()) == "0abcd!"
+
+    def test_transaction_order(self):
+        bus = VoomBus()
+        msgs = []
+        bus.subscribe(str, msgs.append)
+        with bus.transaction():
+            bus.publish("plain-1")
+            bus.publish("high", priority=BusPriority.HIGH_PRIORITY)
+            bus.publish("plain-2")
+        assert msgs == ["plain-1", "plain-2", "high"], msgs
+
+
+class TestQueueLimits(unittest.TestCase):
+    def _drain(self, s):
+        return [m for m in s.consume_messages()]
+
+    def test_raise(self):
+        s = TrxState(QueueLimits(max_depth=2))
+        s.enqueue(1)
+        s.enqueue(2)
+        with nose.tools.assert_raises(QueueFull): #@UndefinedVariable
+            s.enqueue(3)
+        assert self._drain(s) == [1, 2]
+        assert s.high_water == 2
+        assert s.overflows == 1
+
+    def test_max_bytes(self):
+        s = TrxState(QueueLimits(max_bytes=10, sizeof=len))
+        s.enqueue("abcd")
+        s.enqueue("efgh")
+        with nose.tools.assert_raises(QueueFull): #@UndefinedVariable
+            s.enqueue("ijk")
+        s.enqueue("ij")
+        assert s.high_water_bytes == 10
+        assert self._drain(s) == ["abcd", "efgh", "ij"]
+        s.enqueue("0123456789")
+        assert self._drain(s) == ["0123456789"]
+
+    def test_drop_lowest(self):
+        s = TrxState(QueueLimits(max_depth=2, policy=QueueLimits.DROP_LOWEST))
+        s.enqueue("low", priority=30)
+        s.enqueue("mid", priority=20)
+        s.enqueue("high", priority=10)
+        s.enqueue("lowest", priority=40)
+        assert self._drain(s) == ["high", "mid"]
+        assert s.dropped == 2
+
+    def test_drop_lowest_bytes(self):
+        s = TrxState(QueueLimits(max_bytes=100, policy=QueueLimits.DROP_LOWEST,
+                                 sizeof=lambda body: 40))
+        for i in range(6):
+            s.enqueue(i)
+            assert s.size() * 40 == s._bytes <= 100, (s.size(), s._bytes)
+        s.enqueue("urgent", priority=0)
+        assert s.size() * 40 == s._bytes <= 100
+        assert self._drain(s) == ["urgent", 0]
+        assert s.dropped == 5
+
+    def test_spill(self):
+        s = TrxState(QueueLimits(max_depth=2, policy=QueueLimits.SPILL))
+        session = ChainedDict(k='v')
+        for i in range(5):
+            s.enqueue(MessageEnvelope(i, session))
+        s.enqueue(MessageEnvelope("urgent", session), priority=0)
+        assert s.size() == 6
+        assert s.spilled == 4
+        assert [m.body for m in s.pending()] == ["urgent", 0, 1, 2, 3, 4]
+        out = []
+        for m in s.consume_messages():
+            assert m.context is session
+            out.append(m.body)
+            if m.body == 2:
+                s.enqueue(MessageEnvelope(5, session))
+        assert out == ["urgent", 0, 1, 2, 3, 4, 5], out
+        assert s._spill_file is None
+
+    def test_invalid(self):
+        with nose.tools.assert_raises(ValueError): #@UndefinedVariable
+            QueueLimits(policy='wait')
+        with nose.tools.assert_raises(ValueError): #@UndefinedVariable
+            QueueLimits(max_depth=0)
+
 
 class TestSession(unittest.TestCase):
     def test1(self):
@@ -76,6 +183,67 @@ class TestSession(unittest.TestCase):
         assert s.get(1) == 2
         assert s.get(2) == None
 
+    def test_chain(self):
+        root = ChainedDict(a=1)
+        leaf = root.extend().extend()
+        leaf['b'] = 2
+        assert leaf['a'] == 1
+        assert leaf.get('a') == 1
+        assert 'a' in leaf
+        assert 'b' not in root
+        assert leaf.get('c', 3) == 3
+        with nose.tools.assert_raises(KeyError): #@UndefinedVariable
+            leaf['c']
+        assert leaf.flatten() == dict(a=1, b=2)
+
+    def test_snapshot(self):
+        root = ChainedDict(a=1)
+        child = root.extend()
+        root['a'] = 2
+        root['b'] = 3
+        # existing frames keep the snapshot taken when extended
+        assert child['a'] == 1
+        assert 'b' not in child
+        # new frames see the change
+        assert root.extend()['a'] == 2
+        child['a'] = 4
+        del root['b']
+        assert child.extend()['a'] == 4
+        assert 'b' not in root.extend()
+
+    def test_deep(self):
+        d = ChainedDict(a=0)
+        for i in range(1, 300):
+            d = d.extend()
+            d[i] = i
+            if i % 7 == 0:
+                d['a'] = i
+        assert len(d._base) < 12, len(d._base)
+        assert d['a'] == 294
+        assert d[1] == 1 and d[298] == 298 and d[299] == 299
+        assert 150 in d and 300 not in d
+        assert d.flatten() == dict([(i, i) for i in range(1, 300)], a=294)
+
+    def test_pickle(self):
+        leaf = ChainedDict(a=1).extend()
+        leaf['b'] = 2
+        copy = pickle.loads(pickle.dumps(leaf, pickle.HIGHEST_PROTOCOL))
+        assert copy == dict(b=2)
+        assert copy.flatten() == dict(a=1, b=2)
+
+    def test_stack(self):
+        stack = CactusStack()
+        with stack.push_frame(data=dict(a=1)) as f:
+            assert stack.frame is f
+            assert f.parent is stack.globals
+            assert f == dict(a=1)
+            frame = ChainedDict()
+            with stack.push_frame(frame) as f2:
+                assert f2 is frame
+                assert stack.frame is frame
+            assert stack.frame is f
+        assert stack.frame is stack.globals
+
 
 class TestHeaders(unittest.TestCase):
     def setUp(self):
@@ -157,3 +325,18 @@ class TestContextVars(unittest.TestCase):
             self.bus.publish(msg)
         self.assertEquals(200, self.context)
         self.assertEquals(606, self.context2)
+
+
+class TestLocalFactory(unittest.TestCase):
+    def test_custom(self):
+        class SharedLocal(TrxLocal):
+            pass
+
+        bus = VoomBus(local_factory=SharedLocal)
+        assert isinstance(bus._tls, SharedLocal)
+        msgs = []
+        bus.subscribe(str, lambda s: msgs.append(bus.trx.is_running()))
+        bus.publish("a")
+        assert msgs == [True]
+        bus.resetConfig()
+        assert isinstance(bus._tls, SharedLocal)
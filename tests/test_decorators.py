@@ -1,3 +1,5 @@
+from collections import namedtuple
+import pickle
 from voom.decorators import MessageHandlerWrapper, receiver
 import nose.tools
 import unittest
@@ -22,6 +24,16 @@ class TestWrapper(unittest.TestCase):
         assert w(1) == None
 
 
+    def test_where(self):
+        Order = namedtuple("Order", "status region")
+        w = MessageHandlerWrapper(foo, [Order]).where(status="open").where_in(region=["eu", "us"])
+        assert w(Order("open", "eu")) == 1
+        assert w(Order("open", "apac")) == None
+        assert w(Order("closed", "us")) == None
+        assert w(None) == None
+        assert w.matches(Order("open", "us"))
+
+
 class TestDecorator(unittest.TestCase):
     def test_default(self):
         w = receiver(int, str)(foo)
@@ -40,3 +52,13 @@ class TestDecorator(unittest.TestCase):
     def test_bad_args(self):
         with nose.tools.assert_raises(TypeError): #@UndefinedVariable
             _w = receiver(int, str, async=True)(foo)
+
+
+@receiver(int)
+def picklable(_msg):
+    return 2
+
+
+class TestPickle(unittest.TestCase):
+    def test_by_reference(self):
+        assert pickle.loads(pickle.dumps(picklable)) is picklable
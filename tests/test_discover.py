@@ -0,0 +1,166 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from voom.adaptors.django import discover
+from voom.adaptors.django.discover import build_manifest, write_manifest, ManifestLoader, \
+    FinderCache, find_related_module
+from voom.bus import VoomBus
+from voom.events.base import Event
+
+Ping = Event.new("Ping", "n")
+Pong = Event.new("Pong", "n")
+LoudPing = Ping.new("LoudPing", "n")
+
+# the bus the synthetic apps' handler modules subscribe to
+BUS = None
+RECEIVED = []
+
+APPS = {
+    'pinger': "BUS.subscribe(Ping, lambda m: RECEIVED.append(('pinger', m)))",
+    'ponger': "BUS.subscribe(Pong, lambda m: RECEIVED.append(('ponger', m)))",
+    'auditor': "BUS.subscribe(BUS.ALL, lambda m: RECEIVED.append(('auditor', m)))",
+    'quiet': None,
+}
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        global BUS
+        self.dir = tempfile.mkdtemp()
+        for app, handlers in APPS.items():
+            package = os.path.join(self.dir, "voomapp_" + app)
+            os.mkdir(package)
+            open(os.path.join(package, "__init__.py"), "w").close()
+            if handlers:
+                with open(os.path.join(package, "handlers.py"), "w") as f:
+                    f.write("from tests.test_discover import *\n" + handlers + "\n")
+        sys.path.insert(0, self.dir)
+        self.apps = ["voomapp_" + app for app in sorted(APPS)]
+        BUS = VoomBus()
+        RECEIVED[:] = []
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        shutil.rmtree(self.dir)
+        self._unload()
+
+    def _unload(self):
+        for name in list(sys.modules):
+            if name.startswith("voomapp_"):
+                del sys.modules[name]
+
+    def _build(self):
+        manifest = build_manifest(BUS, self.apps)
+        self._unload()
+        return manifest
+
+    def test_build(self):
+        manifest = self._build()
+        assert manifest['types'] == {
+            'tests.test_discover.Ping': ['voomapp_pinger.handlers'],
+            'tests.test_discover.Pong': ['voomapp_ponger.handlers'],
+        }, manifest
+        assert manifest['eager'] == ['voomapp_auditor.handlers']
+        assert sorted(manifest['timings']) == ['voomapp_auditor', 'voomapp_pinger', 'voomapp_ponger']
+
+    def test_lazy(self):
+        global BUS
+        path = os.path.join(self.dir, "manifest.json")
+        write_manifest(self._build(), path)
+
+        BUS = VoomBus()
+        ManifestLoader(path).install(BUS)
+        BUS.publish(Ping(1))
+        assert 'voomapp_pinger.handlers' in sys.modules
+        assert 'voomapp_auditor.handlers' in sys.modules
+        assert 'voomapp_ponger.handlers' not in sys.modules
+        assert sorted(RECEIVED) == [('auditor', Ping(1)), ('pinger', Ping(1))], RECEIVED
+        assert 'voomapp_pinger' in discover.import_timings
+
+        RECEIVED[:] = []
+        BUS.publish(Pong(2))
+        assert sorted(RECEIVED) == [('auditor', Pong(2)), ('ponger', Pong(2))], RECEIVED
+
+    def test_subclass(self):
+        global BUS
+        manifest = self._build()
+        BUS = VoomBus(polymorphic=True)
+        ManifestLoader(manifest).install(BUS)
+        BUS.publish(LoudPing(3))
+        assert ('pinger', LoudPing(3)) in RECEIVED, RECEIVED
+
+    def test_version(self):
+        with self.assertRaises(ValueError):
+            ManifestLoader(dict(version=0, types={}, eager=[]))
+
+
+class TestFinderCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.package = os.path.join(self.dir, "voomapp_cached")
+        os.mkdir(self.package)
+        open(os.path.join(self.package, "__init__.py"), "w").close()
+        self.path = os.path.join(self.dir, "cache.json")
+        sys.path.insert(0, self.dir)
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        shutil.rmtree(self.dir)
+        for name in list(sys.modules):
+            if name.startswith("voomapp_"):
+                del sys.modules[name]
+
+    def _find(self):
+        cache = FinderCache(self.path)
+        with patch('voom.adaptors.django.discover._find_module',
+                   side_effect=discover._find_module) as probe:
+            module = find_related_module("voomapp_cached", "handlers", cache)
+        cache.save()
+        return module, probe.call_count
+
+    def test_cached(self):
+        assert self._find() == (None, 1)
+        assert self._find() == (None, 0)
+
+    def test_invalidated_by_mtime(self):
+        assert self._find() == (None, 1)
+        with open(os.path.join(self.package, "handlers.py"), "w") as f:
+            f.write("LOADED = True\n")
+        # the directory's mtime changes when a file is added; make sure it's visible.
+        os.utime(self.package, (0, os.stat(self.package).st_mtime + 10))
+        module, probes = self._find()
+        assert module.LOADED
+        assert probes == 1
+        assert self._find()[1] == 0
+
+    def test_corrupt(self):
+        with open(self.path, "w") as f:
+            f.write("{")
+        assert self._find() == (None, 1)
+        assert self._find() == (None, 0)
+
+
+class TestTypeLoader(unittest.TestCase):
+    def test_once_per_type(self):
+        bus = VoomBus()
+        loaded = []
+        msgs = []
+
+        def load(message_type):
+            loaded.append(message_type)
+            bus.subscribe(message_type, msgs.append)
+
+        bus.type_loader = load
+        bus.publish(Ping(1))
+        bus.publish(Ping(2))
+        bus.subscribe(str, msgs.append)
+        bus.publish(Ping(3))
+        assert loaded == [Ping], loaded
+        assert msgs == [Ping(1), Ping(2), Ping(3)], msgs
+        with self.assertRaises(ValueError):
+            bus.type_loader = lambda t: None
@@ -0,0 +1,52 @@
+from unittest.case import SkipTest
+import unittest
+
+from voom.bus import VoomBus
+from voom.context import SessionKeys
+from voom.local import CurrentThreadChannel
+
+try:
+    import gevent
+    from voom.adaptors.gevent import GreenletTrxLocal
+except ImportError:
+    gevent = None
+
+
+class TestGreenletLocal(unittest.TestCase):
+    def setUp(self):
+        if gevent is None:
+            raise SkipTest("gevent is not installed")
+        self.bus = VoomBus(local_factory=GreenletTrxLocal)
+        self.msgs = []
+        self.bus.subscribe(int, lambda i: self.msgs.append((i, self.bus.session['name'])))
+
+    def test_isolated_transactions(self):
+        def worker(name, i):
+            with self.bus.using(dict(name=name)):
+                with self.bus.transaction() as (nested, state):
+                    assert not nested
+                    self.bus.publish(i)
+                    gevent.sleep(0)
+                    assert state.size() == 1
+                    assert state is self.bus.trx
+
+        gevent.joinall([gevent.spawn(worker, "a", 1),
+                        gevent.spawn(worker, "b", 2)])
+        assert sorted(self.msgs) == [(1, "a"), (2, "b")], self.msgs
+        assert not self.bus.trx.is_running()
+
+    def test_isolated_replies(self):
+        self.bus.subscribe(str, lambda s: self.bus.reply(s))
+        replies = {}
+
+        def worker(name):
+            with self.bus.using({SessionKeys.REPLY_TO: CurrentThreadChannel.ADDRESS}):
+                self.bus.publish(name)
+                gevent.sleep(0)
+                self.bus.publish(name.lower())
+            gevent.sleep(0)
+            replies[name] = self.bus.thread_channel.pop_all()
+
+        gevent.joinall([gevent.spawn(worker, "A"),
+                        gevent.spawn(worker, "B")])
+        assert replies == dict(A=["A", "a"], B=["B", "b"]), replies
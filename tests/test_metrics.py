@@ -0,0 +1,91 @@
+import unittest
+
+from voom.bus import VoomBus
+from voom.metrics import DispatchMetrics
+
+
+def ok(msg):
+    pass
+
+
+def fail(msg):
+    raise ValueError(msg)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.bus = VoomBus()
+        self.bus.subscribe(str, ok)
+        self.bus.subscribe(str, fail)
+        self.bus.subscribe(int, ok)
+
+    def test_disabled(self):
+        assert self.bus.metrics is None
+        self.bus.publish("a")
+        for _priority, callback, invoke in self.bus._plans[str]:
+            assert invoke.func == self.bus.invoke
+            assert invoke.args == (callback,)
+
+    def test_counts(self):
+        metrics = self.bus.enable_metrics(DispatchMetrics(bounds=(1.0, 0.5)))
+        self.bus.publish("a")
+        self.bus.publish("b")
+        self.bus.publish(1)
+
+        snapshot = metrics.snapshot()
+        ok_stats = snapshot['handlers'][__name__ + '.ok']
+        assert ok_stats['calls'] == 3
+        assert ok_stats['errors'] == 0
+        assert ok_stats['bounds'] == [0.5, 1.0]
+        assert sum(ok_stats['counts']) == 3
+        assert len(ok_stats['counts']) == 3
+
+        fail_stats = snapshot['handlers'][__name__ + '.fail']
+        assert fail_stats['calls'] == 2
+        assert fail_stats['errors'] == 2
+
+        str_stats = snapshot['types']['__builtin__.str']
+        assert str_stats['calls'] == 4
+        assert str_stats['errors'] == 2
+        assert snapshot['types']['__builtin__.int']['calls'] == 1
+
+        metrics.reset()
+        assert metrics.snapshot() == dict(types={}, handlers={})
+
+    def test_bound_methods(self):
+        class Handler(object):
+            def handle(self, msg):
+                pass
+
+        first, second = Handler(), Handler()
+        metrics = self.bus.enable_metrics()
+        self.bus.subscribe(float, first.handle)
+        self.bus.subscribe(float, second.handle)
+        self.bus.publish(1.0)
+        self.bus.publish(2.0)
+        handlers = metrics.snapshot()['handlers']
+        name = __name__ + '.Handler.handle'
+        assert handlers[name + ' at 0x%x' % id(first)]['calls'] == 2, handlers.keys()
+        assert handlers[name + ' at 0x%x' % id(second)]['calls'] == 2
+        assert name not in handlers
+
+    def test_latency_buckets(self):
+        metrics = DispatchMetrics(bounds=(0.1, 1.0))
+        metrics.record(str, ok, 0.05)
+        metrics.record(str, ok, 0.5)
+        metrics.record(str, ok, 2.0, failed=True)
+        stats = metrics.snapshot()['handlers'][__name__ + '.ok']
+        assert stats['counts'] == [1, 1, 1], stats
+        assert stats['errors'] == 1
+        assert abs(stats['mean'] - 2.55 / 3) < 1e-9
+
+    def test_disable(self):
+        metrics = self.bus.enable_metrics()
+        self.bus.publish("a")
+        outbox = self.bus.outbox = object()
+        self.bus.disable_metrics()
+        assert self.bus.outbox is outbox
+        self.bus.outbox = None
+        self.bus.publish("a")
+        assert self.bus.metrics is None
+        assert metrics.snapshot()['handlers'][__name__ + '.ok']['calls'] == 1
@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from voom.bus import VoomBus, BusPriority
+from voom.context import MessageEnvelope, ChainedDict
+from voom.outbox import SQLiteOutbox, FileOutbox, Outbox, encode, decode
+
+
+class OutboxTests(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "outbox")
+        self.outbox = self.create()
+        self.bus = VoomBus(raise_errors=True)
+        self.bus.outbox = self.outbox
+        self.msgs = []
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.dir)
+
+    def bodies(self):
+        return [decode(r)[0] for _, r in self.outbox.pending()]
+
+    def test_roundtrip(self):
+        ids = self.outbox.append([encode(MessageEnvelope(i, ChainedDict(k=i))) for i in range(3)])
+        assert len(ids) == 3
+        self.outbox.ack(ids[1:2])
+        assert self.bodies() == [0, 2]
+        self.outbox.close()
+
+        self.outbox = self.create()
+        assert self.bodies() == [0, 2]
+        self.bus.subscribe(int, lambda i: self.msgs.append((i, self.bus.session['k'])))
+        assert self.outbox.replay(self.bus) == 2
+        assert self.msgs == [(0, 0), (2, 2)], self.msgs
+        assert self.outbox.pending() == []
+        assert self.outbox.append([encode(MessageEnvelope(3, None))]) > ids
+
+    def test_transaction(self):
+        self.bus.subscribe(int, lambda i: self.msgs.append(self.bodies()))
+        with self.bus.transaction():
+            self.bus.publish(1)
+            self.bus.publish(2)
+            assert self.bodies() == []
+        # written before delivery, acknowledged after
+        assert self.msgs == [[1, 2], [1, 2]], self.msgs
+        assert self.bodies() == []
+
+    def test_priorities(self):
+        def fail(i):
+            raise ValueError(i)
+        self.bus.subscribe(int, fail)
+        with self.assertRaises(ValueError):
+            with self.bus.transaction():
+                self.bus.publish(1)
+                self.bus.publish(2, priority=BusPriority.HIGH_PRIORITY)
+                self.bus.publish(3)
+        assert [decode(r)[::2] for _, r in self.outbox.pending()] == \
+            [(1, None), (3, None), (2, BusPriority.HIGH_PRIORITY)]
+        bus = VoomBus()
+        bus.subscribe(int, self.msgs.append)
+        # replayed into one transaction, the original order holds
+        with bus.transaction():
+            assert self.outbox.replay(bus) == 3
+        assert self.msgs == [1, 3, 2], self.msgs
+
+    def test_not_acked_on_failure(self):
+        def fail(i):
+            raise ValueError(i)
+        self.bus.subscribe(int, fail)
+        with self.assertRaises(ValueError):
+            with self.bus.transaction():
+                self.bus.publish(1)
+        assert self.bodies() == [1]
+
+    def test_deferred(self):
+        def h(s):
+            self.bus.defer(len(s))
+        self.bus.subscribe(str, h)
+        self.bus.subscribe(int, lambda i: self.msgs.append(self.bodies()))
+        self.bus.publish("ab")
+        assert self.msgs == [[2]], self.msgs
+        assert self.bodies() == []
+
+    def test_unpicklable_session(self):
+        responder = lambda address, message: None
+        self.outbox.append([encode(MessageEnvelope(1, ChainedDict(ok=1, responder=responder)))])
+        assert decode(self.outbox.pending()[0][1]) == (1, dict(ok=1), None)
+
+
+class TestSQLiteOutbox(OutboxTests, unittest.TestCase):
+    def create(self):
+        return SQLiteOutbox(self.path)
+
+
+class TestFileOutbox(OutboxTests, unittest.TestCase):
+    def create(self):
+        return FileOutbox(self.path)
+
+    def test_truncates(self):
+        ids = self.outbox.append(["a", "b"])
+        self.outbox.ack(ids)
+        assert os.path.getsize(self.path) == 0
+
+    def test_torn_write(self):
+        self.outbox.append(["a"])
+        self.outbox.append(["b"])
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        assert [r for _, r in self.outbox.pending()] == ["a"]
+
+
+class TestGroupCommit(unittest.TestCase):
+    def test_coalesces(self):
+        writes = []
+        started = threading.Event()
+        release = threading.Event()
+
+        class Slow(Outbox):
+            def _write(self, records):
+                writes.append(list(records))
+                started.set()
+                release.wait(5)
+                return range(len(writes) * 10, len(writes) * 10 + len(records))
+
+        outbox = Slow()
+        results = {}
+
+        def append(name):
+            results[name] = outbox.append([name])
+
+        leader = threading.Thread(target=append, args=("a",))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=append, args=(n,)) for n in "bc"]
+        for t in followers:
+            t.start()
+        while len(outbox._waiting) < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        assert writes[0] == ["a"]
+        assert sorted(writes[1]) == ["b", "c"], writes
+        assert len(writes) == 2
+        assert results["a"] == [10]
+        assert sorted(results["b"] + results["c"]) == [20, 21]
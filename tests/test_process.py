@@ -0,0 +1,78 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
+import unittest
+
+from voom.bus import VoomBus
+from voom.decorators import receiver
+from voom.events.base import Event
+from voom.exceptions import AbortProcessing
+
+Job = Event.new("Job", "name")
+Done = Event.new("Done", "name pid session")
+
+BUS = None
+
+
+@receiver(Job, process=True)
+def offloaded(job):
+    if job.name == "fail":
+        raise ValueError(job.name)
+    if job.name == "abort":
+        BUS.defer(Done(job.name, os.getpid(), None))
+        raise AbortProcessing()
+    BUS.publish(Done(job.name, os.getpid(), BUS.session.get('k')))
+    BUS.defer(job.name.upper())
+
+
+class TestProcessOffload(unittest.TestCase):
+    def setUp(self):
+        global BUS
+        BUS = self.bus = VoomBus()
+        self.msgs = []
+        self.bus.register(offloaded)
+        self.bus.subscribe(Done, self.msgs.append)
+        self.bus.subscribe(str, self.msgs.append)
+        self.bus.subscribe(self.bus.ERRORS, self.msgs.append)
+        self.pool = self.bus.process_executor = ProcessPoolExecutor(2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_offload(self):
+        with self.bus.using(dict(k='v')):
+            self.bus.publish(Job("x"))
+        done, deferred = self.msgs
+        assert done.name == "x"
+        assert done.pid != os.getpid()
+        assert done.session == 'v'
+        assert deferred == "X"
+
+    def test_unpicklable_session(self):
+        # request() puts a responder, which holds a lock, in the session
+        with self.bus.using(dict(k='v', lock=threading.Lock())):
+            future = self.bus.request(Job("x"), timeout=0.5)
+        done, deferred = self.msgs
+        assert done.session == 'v'
+        assert deferred == "X"
+        assert self.bus._pending_replies.cancel(future)
+
+    def test_unpicklable_body(self):
+        self.bus.publish(Job(threading.Lock()))
+        failure, = self.msgs
+        assert isinstance(failure.exception, TypeError), failure
+
+    def test_failure(self):
+        self.bus.publish(Job("fail"))
+        failure, = self.msgs
+        assert isinstance(failure.exception, ValueError), failure
+        assert failure.message == Job("fail")
+
+    def test_abort(self):
+        self.bus.publish(Job("abort"))
+        assert self.msgs == [], self.msgs
+
+    def test_inline_without_executor(self):
+        self.bus.process_executor = None
+        self.bus.publish(Job("x"))
+        assert self.msgs[0].pid == os.getpid()
@@ -4,9 +4,10 @@ from voom.bus import VoomBus
 from voom.context import SessionKeys
 from voom.decorators import receiver
 from voom.events import MessageForwarded
-from voom.exceptions import InvalidStateError, InvalidAddressError
-from voom.local import CurrentThreadChannel
+from voom.exceptions import InvalidStateError, InvalidAddressError, RequestTimeout
+from voom.local import CurrentThreadChannel, StreamingChannel
 import nose.tools
+import sys
 import threading
 import unittest
 
@@ -39,6 +40,201 @@ class TestCurrentThreadSendDelegate(unittest.TestCase):
         assert not d.messages
 
 
+class TestStreamingChannel(unittest.TestCase):
+    def test_bounded(self):
+        channel = StreamingChannel(maxsize=2)
+        sent = []
+
+        def produce():
+            for i in range(10):
+                channel(StreamingChannel.ADDRESS, i)
+                sent.append(i)
+            channel.finish()
+
+        t = threading.Thread(target=produce)
+        t.daemon = True
+        t.start()
+        received = []
+        for i in channel:
+            # the sender is never more than the buffer ahead of us
+            assert len(sent) <= i + 3, (i, sent)
+            received.append(i)
+        assert received == range(10)
+
+    def test_close(self):
+        channel = StreamingChannel(maxsize=1)
+        done = threading.Event()
+
+        def produce():
+            for i in range(10):
+                channel(StreamingChannel.ADDRESS, i)
+            done.set()
+
+        t = threading.Thread(target=produce)
+        t.daemon = True
+        t.start()
+        for i in channel:
+            break
+        # abandoning the iteration releases the sender
+        assert done.wait(5)
+
+    def test_error(self):
+        channel = StreamingChannel()
+        channel(None, 1)
+        try:
+            raise ValueError()
+        except ValueError:
+            channel.finish(sys.exc_info())
+        received = []
+        with nose.tools.assert_raises(ValueError): #@UndefinedVariable
+            for i in channel:
+                received.append(i)
+        assert received == [1]
+
+    def test_timeout(self):
+        channel = StreamingChannel(maxsize=1, timeout=0.01)
+        channel(None, 1)
+        # nothing consumes the channel, so the sender gives up on it
+        channel(None, 2)
+        channel(None, 3)
+        channel.finish()
+        assert list(channel) == []
+
+
+class TestBusStream(unittest.TestCase):
+    def test_stream(self):
+        bus = VoomBus()
+        forwarded = []
+
+        @receiver(int)
+        def count(n):
+            for i in range(n):
+                bus.reply(i)
+
+        bus.register(count)
+        bus.subscribe(MessageForwarded, forwarded.append)
+        with bus.using(dict(user='joe')):
+            replies = []
+            for reply in bus.stream(100, maxsize=5):
+                replies.append(reply)
+        assert replies == range(100)
+        assert len(forwarded) == 100
+        assert forwarded[0].address == StreamingChannel.ADDRESS
+
+    def test_session(self):
+        bus = VoomBus()
+        bus.subscribe(int, lambda n: bus.reply(bus.session.get('user')))
+        with bus.using(dict(user='joe')):
+            assert list(bus.stream(1)) == ['joe']
+
+    def test_error(self):
+        bus = VoomBus(raise_errors=True)
+
+        def fail(n):
+            bus.reply(n)
+            raise ValueError(n)
+
+        bus.subscribe(int, fail)
+        received = []
+        with nose.tools.assert_raises(ValueError): #@UndefinedVariable
+            for reply in bus.stream(1):
+                received.append(reply)
+        assert received == [1]
+
+    def test_unconsumed(self):
+        class Bus(VoomBus):
+            max_streams = 1
+
+        bus = Bus()
+        sent = []
+
+        def count(n):
+            for i in range(n):
+                bus.reply(i)
+                sent.append(i)
+
+        bus.subscribe(int, count)
+        first = bus.stream(3, maxsize=1, timeout=0.05)
+        second = bus.stream(2, maxsize=2, timeout=0.05)
+        # the second producer only started once the first gave up on its channel
+        assert sent[:3] == [0, 1, 2], sent
+        assert list(first) == []
+        assert list(second) == [0, 1]
+
+
+class TestBusRequest(unittest.TestCase):
+    def setUp(self):
+        self.bus = VoomBus()
+
+    def test_reply_inline(self):
+        self.bus.subscribe(int, lambda n: self.bus.reply(n * 2))
+        future = self.bus.request(21)
+        assert future.done()
+        assert future.result() == 42
+        assert len(self.bus._pending_replies) == 0
+
+    def test_correlation(self):
+        seen = []
+
+        def handler(n):
+            seen.append(self.bus.session[SessionKeys.CORRELATION_ID])
+            self.bus.reply(n)
+            self.bus.reply("ignored")
+
+        self.bus.subscribe(int, handler)
+        first, second = self.bus.request(1), self.bus.request(2)
+        assert seen == [first.correlation_id, second.correlation_id]
+        assert first.correlation_id != second.correlation_id
+        assert (first.result(), second.result()) == (1, 2)
+
+    def test_reply_later(self):
+        contexts = []
+        self.bus.subscribe(int, lambda n: contexts.append(self.bus.get_reply_context()))
+        futures = [self.bus.request(i, timeout=5) for i in range(3)]
+        assert not any(f.done() for f in futures)
+        done = []
+        futures[1].add_done_callback(done.append)
+
+        def answer():
+            for i, context in reversed(list(enumerate(contexts))):
+                self.bus.reply(i * 10, context)
+        t = threading.Thread(target=answer)
+        t.start()
+        assert [f.result(5) for f in futures] == [0, 10, 20]
+        t.join()
+        assert done == [futures[1]]
+
+    def test_timeout(self):
+        self.bus.subscribe(int, lambda n: None)
+        future = self.bus.request(1, timeout=0.02)
+        with nose.tools.assert_raises(RequestTimeout): #@UndefinedVariable
+            future.result(2)
+        assert len(self.bus._pending_replies) == 0
+        # a late reply is dropped
+        self.bus._pending_replies(self.bus._pending_replies.address(future), "late")
+        assert isinstance(future.exception(), RequestTimeout)
+
+    def test_wait_timeout(self):
+        self.bus.subscribe(int, lambda n: None)
+        future = self.bus.request(1)
+        with nose.tools.assert_raises(RequestTimeout): #@UndefinedVariable
+            future.result(0.01)
+        assert not future.done()
+        assert self.bus._pending_replies.cancel(future)
+        assert len(self.bus._pending_replies) == 0
+
+    def test_publish_fails(self):
+        bus = VoomBus(raise_errors=True)
+
+        def fail(n):
+            raise ValueError(n)
+
+        bus.subscribe(int, fail)
+        with nose.tools.assert_raises(ValueError): #@UndefinedVariable
+            bus.request(1)
+        assert len(bus._pending_replies) == 0
+
+
 class TestBusReply(unittest.TestCase):
     def setUp(self):
         self.bus = VoomBus()
@@ -0,0 +1,110 @@
+import threading
+import time
+import unittest
+from operator import itemgetter
+
+from voom.bus import VoomBus
+from voom.sharding import ShardedDispatcher
+
+
+class TestShardedDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.bus = VoomBus()
+        self.lock = threading.Lock()
+        self.handled = []
+
+    def record(self, msg):
+        with self.lock:
+            self.handled.append((msg, threading.current_thread().name, self.bus.session.get('k')))
+
+    def test_order_within_key(self):
+        def handler(msg):
+            time.sleep(0.0005 * (msg[0] % 3))
+            self.record(msg)
+        self.bus.subscribe(tuple, handler)
+        shards = ShardedDispatcher(self.bus, key=itemgetter(0), shards=4)
+        for i in range(50):
+            for user in range(8):
+                shards.publish((user, i))
+        shards.join()
+        assert len(self.handled) == 400
+        for user in range(8):
+            seen = [msg[1] for msg, _, _ in self.handled if msg[0] == user]
+            assert seen == range(50), (user, seen)
+            # every message of a key is handled on the same shard
+            assert len(set(t for msg, t, _ in self.handled if msg[0] == user)) == 1
+        assert len(set(t for _, t, _ in self.handled)) > 1
+        shards.close()
+
+    def test_session(self):
+        self.bus.subscribe(int, self.record)
+        shards = ShardedDispatcher(self.bus, shards=2)
+        with self.bus.using(dict(k='a')):
+            shards.publish(1)
+            shards.publish(3)
+        with self.bus.using(dict(k='b')):
+            shards.publish(5)
+        shards.publish(2)
+        shards.close()
+        assert sorted((msg, k) for msg, _, k in self.handled) == [(1, 'a'), (2, None), (3, 'a'), (5, 'b')]
+
+    def test_errors_keep_shard_alive(self):
+        bus = VoomBus(raise_errors=True)
+
+        def handler(msg):
+            if msg == 1:
+                raise ValueError(msg)
+            self.handled.append(msg)
+        bus.subscribe(int, handler)
+        shards = ShardedDispatcher(bus, shards=1)
+        shards.publish(1)
+        shards.join()
+        shards.publish(2)
+        shards.close()
+        assert self.handled == [2]
+
+    def test_errors_keep_batch(self):
+        bus = VoomBus(raise_errors=True)
+        release = threading.Event()
+
+        def handler(msg):
+            if msg == 0:
+                assert release.wait(5)
+            elif msg in (1, 3):
+                raise ValueError(msg)
+            self.handled.append(msg)
+        bus.subscribe(int, handler)
+        shards = ShardedDispatcher(bus, shards=1)
+        shards.publish(0)
+        # queued behind 0, so they are taken as one batch
+        for i in range(1, 6):
+            shards.publish(i)
+        release.set()
+        shards.close()
+        assert self.handled == [0, 2, 4, 5], self.handled
+
+    def test_errors_before_publishing(self):
+        bus = VoomBus()
+        bus.subscribe(int, self.handled.append)
+        calls = []
+
+        def load():
+            # fails every time, as far as a retry loop could tell
+            calls.append(1)
+            if len(calls) < 5:
+                raise ValueError("no handlers")
+        bus._load = load
+        shards = ShardedDispatcher(bus, shards=1)
+        shards.publish(1)
+        shards.close()
+        # the batch is dropped rather than retried
+        assert len(calls) == 1, len(calls)
+        assert self.handled == []
+
+    def test_shards(self):
+        shards = ShardedDispatcher(self.bus, key=len, shards=3)
+        assert shards.shards == 3
+        assert shards.shard_of("ab") == shards.shard_of("cd") == 2
+        shards.close()
+        with self.assertRaises(ValueError):
+            ShardedDispatcher(self.bus, shards=0)
@@ -0,0 +1,158 @@
+import math
+import random
+import threading
+import time
+import unittest
+
+from voom.timers import TimerWheel, HierarchicalTimerWheel, WheelTimer
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=1, slots=8, now=0)
+
+    def test_expire_in_order(self):
+        for deadline in [5, 3, 4, 3.5]:
+            self.wheel.schedule(deadline, deadline)
+        assert len(self.wheel) == 4
+        assert self.wheel.advance(2) == []
+        assert self.wheel.advance(4) == [3, 3.5, 4]
+        assert self.wheel.advance(4.5) == []
+        assert self.wheel.advance(5) == [5]
+        assert len(self.wheel) == 0
+
+    def test_revolutions(self):
+        # 20 ticks ahead on a wheel of 8 slots
+        self.wheel.schedule(20, "late")
+        self.wheel.schedule(4, "soon")
+        assert self.wheel.advance(12) == ["soon"]
+        assert self.wheel.advance(19) == []
+        assert self.wheel.advance(20) == ["late"]
+
+    def test_jump(self):
+        for deadline in range(1, 40):
+            self.wheel.schedule(deadline, deadline)
+        assert self.wheel.advance(1000) == range(1, 40)
+
+    def test_past(self):
+        self.wheel.advance(10)
+        self.wheel.schedule(3, "past")
+        assert self.wheel.advance(11) == ["past"]
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(3, "x")
+        self.wheel.schedule(3, "y")
+        assert self.wheel.cancel(timer)
+        assert not self.wheel.cancel(timer)
+        assert self.wheel.advance(5) == ["y"]
+        assert len(self.wheel) == 0
+
+
+class TestHierarchicalTimerWheel(unittest.TestCase):
+    def setUp(self):
+        # levels of 1, 4, 16 and 64 ticks per slot
+        self.wheel = HierarchicalTimerWheel(resolution=1, slots=4, levels=4, now=0)
+
+    def test_cascade(self):
+        for deadline in [1, 3, 5, 17, 63, 64, 255, 1000]:
+            self.wheel.schedule(deadline, deadline)
+        expired = []
+        for now in range(1, 1001):
+            due = self.wheel.advance(now)
+            assert all(d <= now for d in due), (now, due)
+            assert all(d == now for d in due), (now, due)
+            expired.extend(due)
+        assert expired == [1, 3, 5, 17, 63, 64, 255, 1000], expired
+        assert len(self.wheel) == 0
+
+    def test_random(self):
+        rnd = random.Random(42)
+        deadlines = [rnd.uniform(0, 300) for _ in range(2000)]
+        timers = [self.wheel.schedule(d, d) for d in deadlines]
+        for timer in timers[::3]:
+            assert self.wheel.cancel(timer)
+        expected = sorted(d for i, d in enumerate(deadlines) if i % 3)
+        expired = []
+        now = 0
+        while now < 300:
+            last, now = now, now + rnd.choice([1, 1, 2, 3, 7])
+            due = self.wheel.advance(now)
+            # nothing early, and nothing that was due by the last advance
+            assert all(last < math.ceil(d) <= now for d in due), (now, due)
+            expired.extend(due)
+        assert expired == expected
+        assert len(self.wheel) == 0
+
+    def test_jump(self):
+        for deadline in [2, 40, 500]:
+            self.wheel.schedule(deadline, deadline)
+        assert self.wheel.advance(100) == [2, 40]
+        self.wheel.schedule(120, 120)
+        assert self.wheel.advance(119) == []
+        assert self.wheel.advance(120) == [120]
+        assert self.wheel.advance(499) == []
+        assert self.wheel.advance(500) == [500]
+
+    def test_beyond_top_level(self):
+        self.wheel.schedule(5000, "far")
+        assert self.wheel.advance(4999) == []
+        assert self.wheel.advance(5000) == ["far"]
+
+    def test_fifo(self):
+        for payload in "abcdef":
+            self.wheel.schedule(30, payload)
+        assert "".join(self.wheel.advance(30)) == "abcdef"
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(100, "x")
+        self.wheel.advance(90)
+        assert self.wheel.cancel(timer)
+        assert self.wheel.advance(200) == []
+
+    def test_catch_up(self):
+        for deadline in range(1, 60):
+            self.wheel.schedule(deadline, deadline)
+        self.wheel.schedule(5000, "far")
+        assert self.wheel.advance(30) == range(1, 31)
+        assert self.wheel.advance(4999) == range(31, 60)
+        assert self.wheel.advance(5000) == ["far"]
+        assert len(self.wheel) == 0
+
+
+class TestWheelTimer(unittest.TestCase):
+    def test_expires(self):
+        fired = threading.Event()
+        expired = []
+
+        def expire(payloads):
+            expired.extend(payloads)
+            fired.set()
+
+        timer = WheelTimer(expire, TimerWheel(resolution=0.005))
+        timer.schedule(time.time() + 0.02, "a")
+        cancelled = timer.schedule(time.time() + 0.01, "b")
+        timer.cancel(cancelled)
+        assert fired.wait(2)
+        timer.stop()
+        assert expired == ["a"]
+
+    def test_slow_expire(self):
+        release = threading.Event()
+        expired = []
+
+        def expire(payloads):
+            assert release.wait(5)
+            expired.extend(payloads)
+
+        timer = WheelTimer(expire, TimerWheel(resolution=0.005))
+        timer.schedule(time.time() + 0.01, "a")
+        timer.schedule(time.time() + 0.05, "b")
+        # the wheel keeps advancing while "a" is being expired
+        deadline = time.time() + 2
+        while timer.wheel and time.time() < deadline:
+            time.sleep(0.005)
+        assert len(timer.wheel) == 0
+        assert expired == []
+        release.set()
+        timer.stop()
+        assert expired == ["a", "b"], expired
@@ -0,0 +1,102 @@
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import time
+import unittest
+
+from voom.bus import VoomBus
+from voom.events.base import Event
+from voom.transport import LocalBroker, BusBridge, encode_frame, decode_frame
+
+CacheInvalidated = Event.new("CacheInvalidated", "key")
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class TestFrames(unittest.TestCase):
+    def test_roundtrip(self):
+        bodies = [CacheInvalidated(i) for i in range(3)] + ["x"]
+        frame = encode_frame(bodies)
+        assert decode_frame(frame[4:]) == bodies
+
+
+class TestBridge(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = self.path = os.path.join(self.dir, "voom.sock")
+        self.broker = LocalBroker(path, max_pending=8)
+        self.buses = [VoomBus(), VoomBus(), VoomBus()]
+        self.received = [[], [], []]
+        self.bridges = []
+        for bus, received in zip(self.buses, self.received):
+            bus.subscribe(CacheInvalidated, received.append)
+            self.bridges.append(BusBridge(bus, path, [CacheInvalidated]))
+        assert wait_for(lambda: len(self.broker._peers) == 3)
+
+    def tearDown(self):
+        for bridge in self.bridges:
+            bridge.close()
+        self.broker.close()
+        shutil.rmtree(self.dir)
+
+    def test_fan_out(self):
+        self.buses[0].publish_many(CacheInvalidated(i) for i in range(100))
+        assert self.bridges[0].flush(5)
+        for received in self.received[1:]:
+            assert wait_for(lambda: len(received) == 100), len(received)
+            assert received == [CacheInvalidated(i) for i in range(100)]
+        # delivered locally once, and not echoed back
+        time.sleep(0.05)
+        assert len(self.received[0]) == 100
+
+    def test_only_bridged_types(self):
+        self.buses[0].publish("local")
+        self.buses[0].publish(CacheInvalidated("k"))
+        assert wait_for(lambda: self.received[1] == [CacheInvalidated("k")])
+
+    def test_close(self):
+        self.bridges[2].close()
+        assert self.bridges[2].send not in [cb for _, cb in self.buses[2]._message_handlers[CacheInvalidated]]
+        self.bridges = self.bridges[:2]
+        self.buses[0].publish(CacheInvalidated("k"))
+        assert wait_for(lambda: self.received[1] == [CacheInvalidated("k")])
+        assert self.received[2] == []
+
+    def test_permissions(self):
+        assert stat.S_IMODE(os.stat(self.path).st_mode) == 0600
+
+    def test_concurrent_senders(self):
+        # large frames from two processes must not interleave on the third's socket.
+        for bus in self.buses[:2]:
+            bus.publish_many(CacheInvalidated(str(bus) * 20000 + str(i)) for i in range(20))
+        for bridge in self.bridges[:2]:
+            assert bridge.flush(5)
+        assert wait_for(lambda: len(self.received[2]) == 40), len(self.received[2])
+        for bus in self.buses[:2]:
+            sent = [CacheInvalidated(str(bus) * 20000 + str(i)) for i in range(20)]
+            assert [r for r in self.received[2] if r.key.startswith(str(bus))] == sent
+
+    def test_slow_peer(self):
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(self.path)
+        try:
+            assert wait_for(lambda: len(self.broker._peers) == 4)
+            keys = ["x" * 100000 + str(i) for i in range(50)]
+            for key in keys:
+                self.buses[0].publish(CacheInvalidated(key))
+                assert self.bridges[0].flush(5)
+            assert wait_for(lambda: len(self.received[1]) == 50), len(self.received[1])
+            assert [r.key for r in self.received[1]] == keys
+            # the peer that never reads fell behind and was dropped
+            assert wait_for(lambda: len(self.broker._peers) == 3)
+        finally:
+            stalled.close()
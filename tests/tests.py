@@ -1,11 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from mock import Mock, patch
 from nose.tools import assert_raises #@UnresolvedImport
 from voom.bus import VoomBus, BusPriority
-from voom.context import TrxState
+from voom.context import TrxState, QueueLimits, SessionKeys
 from voom.decorators import receiver
+from voom.events.base import Event
 from voom.exceptions import BusError, AbortProcessing
+from voom.local import CurrentThreadChannel
 import nose.tools
+import pickle
 import sys
+import threading
+import time
 import unittest
 import voom.bus
 
@@ -160,6 +166,535 @@ class TestErrorQueue(BaseTest):
         failure = msgs[0]
         assert isinstance(failure.exception, FancyException)
 
+    def test_lazy_format(self):
+        msgs = []
+
+        def fail(m):
+            raise ValueError(m)
+
+        self.bus.subscribe(self.bus.ERRORS, msgs.append)
+        self.bus.subscribe(str, fail)
+        self.bus.error_stack_limit = 2
+        self.bus.publish("cows")
+        failure, = msgs
+        assert failure._exc_info is not None
+        assert "ValueError: cows" in failure.stack_trace
+        assert failure._exc_info is None
+        assert len(failure.invocation_context) == 2
+        assert "/voom/" not in failure.invocation_context[-1]
+
+    def test_tuple_compatible(self):
+        msgs = []
+
+        def fail(m):
+            raise ValueError(m)
+
+        self.bus.subscribe(self.bus.ERRORS, msgs.append)
+        self.bus.subscribe(str, fail)
+        self.bus.publish("cows")
+        failure, = msgs
+        message, exception, stack_trace, invocation_context = failure
+        assert message == failure[0] == "cows"
+        assert exception is failure[1]
+        assert stack_trace == failure.stack_trace
+        assert invocation_context == failure[-1]
+        assert len(failure) == 4
+        copy = pickle.loads(pickle.dumps(failure, pickle.HIGHEST_PROTOCOL))
+        assert copy.message == "cows"
+        assert copy.stack_trace == stack_trace
+        assert copy.invocation_context == invocation_context
+
+    def test_invocation_context_is_the_publisher(self):
+        msgs = []
+
+        def fail(m):
+            raise ValueError(m)
+
+        self.bus.subscribe(self.bus.ERRORS, msgs.append)
+        self.bus.subscribe(str, fail)
+        self.bus.publish("cows")
+        failure, = msgs
+        # formatted here, after publish() has returned
+        assert 'self.bus.publish("cows")' in failure.invocation_context[-1]
+
+    def test_skipped_without_handlers(self):
+        def fail(m):
+            raise ValueError(m)
+
+        self.bus.subscribe(str, fail)
+        with patch('voom.bus.InvocationFailure') as failure:
+            self.bus.publish("cows")
+        assert not failure.called
+
+
+class TestDispatchPlan(BaseTest):
+    def test_cached(self):
+        msgs = []
+        self.bus.subscribe(str, msgs.append)
+        self.bus.publish("a")
+        plan = self.bus._plans[str]
+        assert isinstance(plan, tuple)
+        self.bus.publish("b")
+        assert self.bus._plans[str] is plan
+        assert msgs == ["a", "b"], msgs
+
+    def test_invalidated(self):
+        msgs = []
+        self.bus.subscribe(str, msgs.append)
+        self.bus.publish("a")
+
+        generation = self.bus._generation
+        self.bus.subscribe(self.bus.ALL, lambda m: msgs.append("all"))
+        assert self.bus._generation > generation
+        assert str not in self.bus._plans
+        self.bus.publish("b")
+        assert msgs == ["a", "b", "all"], msgs
+
+        msgs[:] = []
+        self.bus.unsubscribe(str, msgs.append)
+        self.bus.publish("c")
+        assert msgs == ["all"], msgs
+
+        self.bus.resetConfig()
+        self.bus.publish("d")
+        assert msgs == ["all"], msgs
+
+
+class TestFilterIndex(BaseTest):
+    Order = Event.new("Order", "status region")
+
+    def setUp(self):
+        super(TestFilterIndex, self).setUp()
+        self.calls = []
+        for status in ["open", "closed", "held"]:
+            self.bus.register(self._handler(status).where(status=status))
+
+    def _handler(self, name, priority=None):
+        @receiver(self.Order, priority=priority)
+        def handler(msg):
+            self.calls.append(name)
+        handler.__name__ = name
+        return handler
+
+    def test_only_matching_called(self):
+        self.bus.publish(self.Order("closed", "eu"))
+        assert self.calls == ["closed"], self.calls
+        self.calls[:] = []
+        self.bus.publish(self.Order("lost", "eu"))
+        assert self.calls == []
+
+    def test_order_and_unfiltered(self):
+        self.bus.register(self._handler("first", BusPriority.HIGH_PRIORITY))
+        self.bus.register(self._handler("eu-open", BusPriority.LOW_PRIORITY)
+                          .where(status="open").where_in(region=["eu", "uk"]))
+        self.bus.register(self._handler("last", BusPriority.LOW_PRIORITY + 1))
+        self.bus.publish(self.Order("open", "uk"))
+        assert self.calls == ["first", "open", "eu-open", "last"], self.calls
+        self.calls[:] = []
+        self.bus.publish(self.Order("open", "us"))
+        assert self.calls == ["first", "open", "last"], self.calls
+
+    def test_not_invoked(self):
+        invoked = []
+        self.bus.add_middleware(lambda invoke, callback: lambda m: (invoked.append(callback.__name__), invoke(m)))
+        self.bus.publish(self.Order("held", "eu"))
+        assert invoked == ["held"], invoked
+
+    def test_callable_filter_fallback(self):
+        handler = self._handler("big")
+        handler.filter(lambda msg: msg.region == "big")
+        self.bus.register(handler)
+        self.bus.publish(self.Order("none", "big"))
+        self.bus.publish(self.Order("none", "small"))
+        assert self.calls == ["big"], self.calls
+
+    def test_unhashable_field(self):
+        self.bus.publish(self.Order(["open"], "eu"))
+        assert self.calls == []
+
+
+class TestPolymorphic(BaseTest):
+    def test_exact_by_default(self):
+        msgs = []
+        self.bus.subscribe(Event, msgs.append)
+        self.bus.publish(Event.new("Ev", "a")(1))
+        assert msgs == [], msgs
+
+    def test_subclasses(self):
+        Ev = Event.new("Ev", "a")
+        SubEv = Ev.new("SubEv", "a")
+        msgs = []
+        self.bus.polymorphic = True
+        self.bus.subscribe(Event, lambda m: msgs.append("event"), priority=BusPriority.LOW_PRIORITY)
+        self.bus.subscribe(Ev, lambda m: msgs.append("ev"))
+        self.bus.subscribe(SubEv, lambda m: msgs.append("sub"), priority=BusPriority.HIGH_PRIORITY)
+
+        self.bus.publish(SubEv(1))
+        assert msgs == ["sub", "ev", "event"], msgs
+        msgs[:] = []
+        self.bus.publish(Ev(1))
+        assert msgs == ["ev", "event"], msgs
+
+    def test_once_per_callback(self):
+        Ev = Event.new("Ev", "a")
+        msgs = []
+        bus = VoomBus(polymorphic=True)
+        bus.subscribe(Event, msgs.append, priority=BusPriority.LOW_PRIORITY)
+        bus.subscribe(Ev, msgs.append, priority=BusPriority.HIGH_PRIORITY)
+        bus.publish(Ev(1))
+        assert msgs == [Ev(1)], msgs
+        assert [entry[:2] for entry in bus._plans[Ev]] == [(BusPriority.HIGH_PRIORITY, msgs.append)]
+
+    def test_toggle_invalidates(self):
+        Ev = Event.new("Ev", "a")
+        msgs = []
+        self.bus.subscribe(Event, msgs.append)
+        self.bus.publish(Ev(1))
+        self.bus.polymorphic = True
+        self.bus.publish(Ev(2))
+        assert msgs == [Ev(2)], msgs
+
+
+class TestPublishMany(BaseTest):
+    def _record(self, bus):
+        msgs = []
+
+        def parent(s):
+            msgs.append(s)
+            bus.publish(len(s))
+
+        def child(i):
+            msgs.append(i)
+
+        bus.subscribe(str, parent)
+        bus.subscribe(int, child)
+        return msgs
+
+    def test_same_as_sequential(self):
+        expected = self._record(self.bus)
+        for s in ["a", "bb", "ccc"]:
+            self.bus.publish(s)
+
+        bus = VoomBus()
+        msgs = self._record(bus)
+        bus.publish_many(iter(["a", "bb", "ccc"]))
+        assert msgs == expected == ["a", 1, "bb", 2, "ccc", 3], msgs
+        assert not bus.trx.is_running()
+        assert bus.trx.is_queue_empty()
+
+    def test_in_transaction(self):
+        msgs = self._record(self.bus)
+        with self.bus.transaction():
+            self.bus.publish_many(["a", "bb"])
+            assert msgs == []
+            assert self.bus.trx.size() == 2
+        assert msgs == ["a", "bb", 1, 2], msgs
+
+    def test_session(self):
+        sessions = []
+        self.bus.subscribe(int, lambda i: sessions.append(self.bus.session.get('k')))
+        with self.bus.using(dict(k='v')):
+            self.bus.publish_many([1, 2])
+        self.bus.publish_many([])
+        assert sessions == ['v', 'v'], sessions
+
+
+class TestQueueLimits(BaseTest):
+    def _fan_out(self, bus, n):
+        msgs = []
+
+        def parent(s):
+            msgs.append(s)
+            for i in range(n):
+                bus.publish(i)
+
+        bus.subscribe(str, parent)
+        bus.subscribe(int, msgs.append)
+        return msgs
+
+    def test_raise(self):
+        limits = QueueLimits(max_depth=3)
+        bus = VoomBus(queue_limits=limits)
+        msgs = self._fan_out(bus, 5)
+        errors = []
+        bus.subscribe(bus.ERRORS, errors.append)
+        bus.publish("a")
+        assert msgs == ["a", 0, 1, 2], msgs
+        assert len(errors) == 1
+        assert limits.snapshot()['high_water'] == 3
+        assert limits.snapshot()['overflows'] == 1
+
+    def test_block(self):
+        limits = QueueLimits(max_depth=2, policy=QueueLimits.BLOCK)
+        bus = VoomBus(queue_limits=limits)
+        msgs = self._fan_out(bus, 5)
+        bus.publish("a")
+        # everything is delivered, in order, without the queue growing past 2
+        assert msgs == ["a", 0, 1, 2, 3, 4], msgs
+        assert limits.high_water == 2, limits.high_water
+        assert bus.trx.is_queue_empty()
+
+    def test_block_keeps_deferred(self):
+        bus = VoomBus(queue_limits=QueueLimits(max_depth=1, policy=QueueLimits.BLOCK))
+        msgs = []
+
+        def parent(s):
+            bus.defer(u"deferred")
+            bus.publish(1)
+            bus.publish(2)
+            bus.publish(3)
+            msgs.append(s)
+
+        bus.subscribe(str, parent)
+        bus.subscribe(int, msgs.append)
+        bus.subscribe(unicode, msgs.append)
+        bus.publish("a")
+        # 1 and 2 are dispatched to make room for 2 and 3
+        assert msgs == [1, 2, "a", 3, u"deferred"], msgs
+
+    def test_drop_lowest(self):
+        limits = QueueLimits(max_depth=3, policy=QueueLimits.DROP_LOWEST)
+        bus = VoomBus(queue_limits=limits)
+        msgs = self._fan_out(bus, 5)
+        bus.publish("a")
+        assert msgs == ["a", 0, 1, 2], msgs
+        assert limits.snapshot()['dropped'] == 2
+
+    def test_spill(self):
+        limits = QueueLimits(max_depth=3, policy=QueueLimits.SPILL)
+        bus = VoomBus(queue_limits=limits)
+        msgs = self._fan_out(bus, 10)
+        bus.publish("a")
+        assert msgs == ["a"] + range(10), msgs
+        assert limits.snapshot()['spilled'] == 7
+
+
+class TestScheduled(BaseTest):
+    def setUp(self):
+        super(TestScheduled, self).setUp()
+        self.msgs = []
+        self.done = threading.Event()
+        self.bus.subscribe(str, self.receive)
+
+    def receive(self, s):
+        self.msgs.append((s, self.bus.session.get('k'), threading.current_thread().name))
+        if s == "last":
+            self.done.set()
+
+    def test_publish_after(self):
+        with self.bus.using(dict(k='v')):
+            self.bus.publish_after("last", 0.03)
+            self.bus.publish_after("first", 0.01)
+            self.bus.publish_at("second", time.time() + 0.02)
+        assert self.msgs == []
+        assert self.done.wait(5)
+        assert [m[:2] for m in self.msgs] == [("first", 'v'), ("second", 'v'), ("last", 'v')], self.msgs
+        assert self.msgs[0][2] == "voom-scheduler-expire"
+
+    def test_batch_in_one_transaction(self):
+        transactions = []
+        self.bus.subscribe(str, lambda s: transactions.append(id(self.bus.trx)))
+        when = time.time() + 0.01
+        for s in ["a", "b", "last"]:
+            self.bus.publish_at(s, when)
+        assert self.done.wait(5)
+        assert [m[0] for m in self.msgs] == ["a", "b", "last"]
+        assert len(set(transactions)) == 1
+
+    def test_cancel(self):
+        handle = self.bus.publish_after("cancelled", 0.01)
+        self.bus.publish_after("last", 0.02)
+        assert self.bus.cancel_scheduled(handle)
+        assert self.done.wait(5)
+        assert [m[0] for m in self.msgs] == ["last"]
+        assert not self.bus.cancel_scheduled(handle)
+
+    def test_cancel_without_scheduler(self):
+        other = VoomBus()
+        handle = other.publish_after("elsewhere", 60)
+        other._scheduler.stop()
+        assert self.bus._scheduler is None
+        assert not self.bus.cancel_scheduled(handle)
+
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(4)
+        self.bus = VoomBus(executor=self.pool)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_concurrent_band(self):
+        a, b = threading.Event(), threading.Event()
+        msgs = []
+
+        @receiver(str, independent=True)
+        def h1(s):
+            a.set()
+            assert b.wait(5)
+            msgs.append(1)
+
+        @receiver(str, independent=True)
+        def h2(s):
+            b.set()
+            assert a.wait(5)
+            msgs.append(2)
+
+        @receiver(str, priority=BusPriority.LOW_PRIORITY)
+        def after(s):
+            msgs.append(3)
+
+        self.bus.subscribe(self.bus.ERRORS, msgs.append)
+        self.bus.register(h1)
+        self.bus.register(h2)
+        self.bus.register(after)
+        self.bus.publish("x")
+        assert sorted(msgs[:2]) == [1, 2], msgs
+        assert msgs[2:] == [3], msgs
+
+    def test_session_and_messages(self):
+        msgs = []
+
+        @receiver(str, independent=True)
+        def worker(s):
+            assert self.bus.current_message.body == s
+            msgs.append((s, self.bus.session['k'], threading.current_thread().name))
+            self.bus.publish(1)
+            self.bus.defer(2.0)
+
+        self.bus.register(worker)
+        self.bus.subscribe(int, lambda i: msgs.append((i, self.bus.session['k'])))
+        self.bus.subscribe(float, msgs.append)
+        with self.bus.using(dict(k='v')):
+            self.bus.publish("x")
+        assert msgs[0][:2] == ("x", "v"), msgs
+        assert msgs[0][2] != threading.current_thread().name
+        assert msgs[1:] == [(1, 'v'), 2.0], msgs
+        assert not self.bus.trx.is_running()
+
+    def test_reply_on_thread_channel(self):
+        @receiver(str, independent=True)
+        def pong(s):
+            self.bus.reply("pong")
+
+        self.bus.register(pong)
+        with self.bus.using({SessionKeys.REPLY_TO: CurrentThreadChannel.ADDRESS}):
+            self.bus.publish("ping")
+        assert self.bus.thread_channel.pop_all() == ["pong"]
+
+    def test_errors(self):
+        failures = []
+
+        @receiver(str, independent=True)
+        def fail(s):
+            raise ValueError(s)
+
+        self.bus.subscribe(self.bus.ERRORS, failures.append)
+        self.bus.register(fail)
+        self.bus.publish("x")
+        assert len(failures) == 1
+        assert isinstance(failures[0].exception, ValueError)
+        assert failures[0].message == "x"
+
+    def test_abort(self):
+        msgs = []
+
+        @receiver(str, independent=True)
+        def abort(s):
+            self.bus.defer(1)
+            raise AbortProcessing()
+
+        self.bus.register(abort)
+        self.bus.subscribe(str, msgs.append, priority=BusPriority.LOW_PRIORITY)
+        self.bus.subscribe(int, msgs.append)
+        self.bus.publish("x")
+        assert msgs == [], msgs
+
+
+class TestMiddleware(BaseTest):
+    def setUp(self):
+        super(TestMiddleware, self).setUp()
+        self.calls = []
+        self.compiled = []
+
+    def tracer(self, name):
+        def middleware(invoke, callback):
+            self.compiled.append((name, callback))
+
+            def traced(message):
+                self.calls.append((name, message.body))
+                return invoke(message)
+            return traced
+        return middleware
+
+    def test_order_and_compile_once(self):
+        self.bus.subscribe(str, self.calls.append)
+        self.bus.add_middleware(self.tracer("outer"))
+        self.bus.add_middleware(self.tracer("inner"))
+        self.bus.publish("a")
+        self.bus.publish("b")
+        assert self.calls == [("outer", "a"), ("inner", "a"), "a",
+                              ("outer", "b"), ("inner", "b"), "b"], self.calls
+        assert self.compiled == [("inner", self.calls.append), ("outer", self.calls.append)]
+
+    def test_remove(self):
+        tracer = self.tracer("t")
+        self.bus.subscribe(str, self.calls.append)
+        self.bus.add_middleware(tracer)
+        self.bus.publish("a")
+        self.bus.remove_middleware(tracer)
+        self.bus.publish("b")
+        assert self.calls == [("t", "a"), "a", "b"], self.calls
+
+    def test_selective(self):
+        def only_ints(invoke, callback):
+            if callback is not ints:
+                return invoke
+            return lambda message: invoke(message._replace(body=message.body * 2))
+
+        def ints(i):
+            self.calls.append(i)
+
+        self.bus.subscribe(int, ints)
+        self.bus.subscribe(int, self.calls.append, priority=BusPriority.LOW_PRIORITY)
+        self.bus.add_middleware(only_ints)
+        self.bus.publish(2)
+        assert self.calls == [4, 2], self.calls
+
+    def test_retry(self):
+        def retry(invoke, callback):
+            def retrying(message):
+                try:
+                    invoke(message)
+                except ValueError:
+                    invoke(message)
+            return retrying
+
+        def flaky(s):
+            self.calls.append(s)
+            if len(self.calls) == 1:
+                raise ValueError(s)
+
+        self.bus.add_middleware(retry)
+        self.bus.subscribe(str, flaky)
+        self.bus.subscribe(self.bus.ERRORS, self.compiled.append)
+        self.bus.publish("a")
+        assert self.calls == ["a", "a"], self.calls
+        assert self.compiled == []
+
+    def test_errors(self):
+        def fail(s):
+            raise ValueError(s)
+
+        self.bus.subscribe(str, fail)
+        self.bus.subscribe(self.bus.ERRORS, lambda f: self.calls.append(f.message))
+        self.bus.add_middleware(self.tracer("t"))
+        self.bus.publish("a")
+        assert self.calls[0] == ("t", "a")
+        assert self.calls[1][0] == "t"
+        assert self.calls[2] == "a", self.calls
+
 
 class TestBreadth(BaseTest):
     def test1(self):
@@ -365,6 +900,37 @@ class TestDefer(unittest.TestCase):
         self.bus.publish("s")
         assert self.msgs == ['s', 's', 1]
 
+    def test_many_in_order(self):
+        msgs = []
+
+        def fan_out(msg):
+            for i in xrange(1000):
+                self.bus.defer(i)
+
+        self.bus.subscribe(str, fan_out)
+        self.bus.subscribe(str, msgs.append)
+        self.bus.subscribe(int, msgs.append)
+        self.bus.publish("s")
+        assert msgs == ["s"] + range(1000), msgs[:10]
+        assert not self.bus.trx._deferred
+
+    def test_abort_discards(self):
+        msgs = []
+
+        def fan_out(msg):
+            for i in xrange(10):
+                self.bus.defer(i)
+
+        def abort(msg):
+            raise AbortProcessing()
+
+        self.bus.subscribe(str, fan_out)
+        self.bus.subscribe(str, abort, priority=BusPriority.LOW_PRIORITY)
+        self.bus.subscribe(int, msgs.append)
+        self.bus.publish("s")
+        self.bus.publish(10)
+        assert msgs == [10], msgs
+
 
 class TestWithContext(unittest.TestCase):
     def test_new_frame_when_in_using(self):
@@ -1,14 +1,34 @@
 from logging import getLogger
+from timeit import default_timer
 import imp
 import importlib
+import inspect
+import json
+import marshal
+import os
+import tempfile
+
+try:
+    from importlib.util import find_spec
+except ImportError:
+    find_spec = None
 
 LOG = getLogger(__name__)
 
 _RACE_PROTECTION = False  # protect against shenanigans.
 
+MANIFEST_VERSION = 1
+
+"""Seconds spent importing each app's handlers, by app."""
+import_timings = {}
+
 
-def autodiscover_bus_handlers():
-    """Include handlers for all applications in ``INSTALLED_APPS``."""
+def autodiscover_bus_handlers(cache_path=None):
+    """Include handlers for all applications in ``INSTALLED_APPS``.
+
+    :param cache_path: a :class:`FinderCache` file; defaults to the
+       ``VOOM_DISCOVERY_CACHE`` setting, if any.
+    """
     from django.conf import settings
     #from django.conf import settings
     global _RACE_PROTECTION
@@ -18,13 +38,18 @@ def autodiscover_bus_handlers():
     _RACE_PROTECTION = True
     try:
         LOG.info("Discovering bus handlers...")
-        return filter(None, [find_related_module(app, "handlers")
-                             for app in settings.INSTALLED_APPS])
+        cache_path = cache_path or getattr(settings, 'VOOM_DISCOVERY_CACHE', None)
+        cache = FinderCache(cache_path) if cache_path else None
+        modules = filter(None, [find_related_module(app, "handlers", cache)
+                                for app in settings.INSTALLED_APPS])
+        if cache is not None:
+            cache.save()
+        return modules
     finally:
         _RACE_PROTECTION = False
 
 
-def find_related_module(app, related_name):
+def find_related_module(app, related_name, cache=None):
     """Given an application name and a module name, tries to find that
     module in the application."""
 
@@ -33,9 +58,185 @@ def find_related_module(app, related_name):
     except AttributeError:
         return
 
+    if cache is not None:
+        found = cache.find(app, related_name, app_path)
+    else:
+        found = _find_module(app, related_name, app_path)
+    if not found:
+        return
+
+    return _import_timed(app, "%s.%s" % (app, related_name))
+
+
+def _find_module(app, related_name, app_path):
+    if find_spec is not None:
+        return find_spec("%s.%s" % (app, related_name)) is not None
     try:
         imp.find_module(related_name, app_path)
     except ImportError:
-        return
+        return False
+    return True
+
+
+class FinderCache(object):
+    """Remembers, in a file, which apps have a given related module.
+
+    Probing for a module stats every file name it could have, in every
+    directory of the app's path; an entry of the cache is checked with a
+    single stat per directory instead, and is discarded when the mtime of
+    one of them changes, as it does whenever a file is added or removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path, 'rb') as f:
+                entries = marshal.load(f)
+            if isinstance(entries, dict):
+                self._entries = entries
+        except (IOError, EOFError, ValueError, TypeError):
+            LOG.info("no usable discovery cache at %s", path)
+
+    def find(self, app, related_name, app_path):
+        """Does the app have the related module?"""
+        key = "%s.%s" % (app, related_name)
+        mtimes = _mtimes(app_path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == mtimes:
+            return entry[1]
+        found = _find_module(app, related_name, app_path)
+        self._entries[key] = (mtimes, found)
+        self._dirty = True
+        return found
+
+    def save(self):
+        """Write the cache, if it changed, replacing the file atomically."""
+        if not self._dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix=".voom-discovery-", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # a cache, so marshal's format changing between versions is harmless.
+                marshal.dump(self._entries, f)
+            os.rename(tmp, self.path)
+        except:
+            os.unlink(tmp)
+            raise
+        self._dirty = False
+
+
+def _mtimes(app_path):
+    mtimes = []
+    for directory in app_path:
+        try:
+            mtimes.append((directory, os.stat(directory).st_mtime))
+        except OSError:
+            mtimes.append((directory, None))
+    return tuple(mtimes)
+
+
+def _import_timed(app, name):
+    start = default_timer()
+    module = importlib.import_module(name)
+    elapsed = default_timer() - start
+    import_timings[app] = import_timings.get(app, 0.0) + elapsed
+    LOG.info("imported %s in %.1fms", name, elapsed * 1000)
+    return module
+
+
+def build_manifest(bus, apps=None, related_name="handlers"):
+    """Import the handler modules of the apps, which default to ``INSTALLED_APPS``,
+    and record which message types each of them subscribes to on the bus.
+
+    Run this at build or deploy time, in a fresh process, and save the result
+    with :func:`write_manifest`; workers then load it with :class:`ManifestLoader`.
+    Modules that subscribe to every message, or to errors, are loaded eagerly.
+    """
+    if apps is None:
+        from django.conf import settings
+        apps = settings.INSTALLED_APPS
+    types = {}
+    eager = []
+    timings = {}
+    for app in apps:
+        before = _subscriptions(bus)
+        start = default_timer()
+        module = find_related_module(app, related_name)
+        if module is None:
+            continue
+        timings[app] = default_timer() - start
+        for key, callbacks in _subscriptions(bus).iteritems():
+            if not callbacks - before.get(key, set()):
+                continue
+            if key is None:
+                eager.append(module.__name__)
+            else:
+                types.setdefault(key, []).append(module.__name__)
+    return dict(version=MANIFEST_VERSION,
+                types=types,
+                eager=sorted(set(eager)),
+                timings=timings)
+
+
+def write_manifest(manifest, path):
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def _subscriptions(bus):
+    """The subscribed callbacks by type name; None for every message and errors."""
+    subscriptions = dict((_type_name(t), set(cb for _, cb in handlers))
+                         for t, handlers in bus._message_handlers.iteritems())
+    subscriptions[None] = set(cb for _, cb in bus._global_handlers + bus._error_handlers)
+    return subscriptions
+
+
+def _type_name(message_type):
+    return "%s.%s" % (message_type.__module__, message_type.__name__)
+
+
+class ManifestLoader(object):
+    """Loads handler modules lazily, as listed by a manifest from
+    :func:`build_manifest`: a module is only imported once a message of a
+    type it handles, or of a subclass of one, is first dispatched.
+
+    >>> ManifestLoader("/srv/app/handlers.json").install(bus)
+
+    Types missing from the manifest get no handlers, so rebuild it whenever
+    the subscriptions change. Import times are added to ``import_timings``.
+
+    :param manifest: the manifest, or the path of a file written by
+       :func:`write_manifest`.
+    """
+
+    def __init__(self, manifest):
+        if isinstance(manifest, basestring):
+            with open(manifest) as f:
+                manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError("unsupported handler manifest version: %r" % manifest.get('version'))
+        self.types = manifest['types']
+        self.eager = manifest['eager']
+        self._imported = set()
+
+    def install(self, bus):
+        bus.loader = self.load_eager
+        bus.type_loader = self.load_type
+
+    def load_eager(self):
+        for name in self.eager:
+            self._import(name)
+
+    def load_type(self, message_type):
+        for klass in inspect.getmro(message_type):
+            for name in self.types.get(_type_name(klass), ()):
+                self._import(name)
 
-    return importlib.import_module("%s.%s" % (app, related_name))
+    def _import(self, name):
+        if name in self._imported:
+            return
+        self._imported.add(name)
+        _import_timed(name.rpartition('.')[0], name)
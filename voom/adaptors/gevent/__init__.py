@@ -0,0 +1,23 @@
+"""Run the bus cooperatively under gevent.
+
+Transaction state, session frames and replies to the current thread channel
+are kept per greenlet, so concurrent greenlets publishing on one thread do
+not share a transaction, nor each other's replies:
+
+>>> from voom.adaptors.gevent import GreenletTrxLocal
+>>> bus = VoomBus(local_factory=GreenletTrxLocal)
+"""
+from gevent.local import local
+
+from voom.context import TrxLocal
+from voom.local import LocalChannel
+
+
+class CurrentGreenletChannel(LocalChannel, local):
+    """Collects the messages sent to the current thread channel address in
+    the current greenlet."""
+
+
+class GreenletTrxLocal(TrxLocal, local):
+    """Greenlet local transaction state."""
+    channel_factory = CurrentGreenletChannel
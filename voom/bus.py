@@ -1,40 +1,88 @@
 import bisect
 import collections
+import cPickle as pickle
 from contextlib import contextmanager
+import functools
 import heapq
 import inspect
+import itertools
 import logging
+import operator
 import sys
 import threading
-import traceback
+import time
+import weakref
 
 from voom.context import MessageEnvelope, InvocationFailure, \
-    SessionKeys, ReplyContext, TrxTLS
+    SessionKeys, ReplyContext, TrxTLS, CapturingTrxState, ChainedDict, snapshot_stack
 from voom.events import MessageForwarded
 from voom.exceptions import AbortProcessing, BusError, InvalidAddressError, \
     InvalidStateError
-from voom.local import CurrentThreadChannel
+from voom.local import CurrentThreadChannel, StreamingChannel, PendingReplies
+from voom.metrics import DispatchMetrics
+from voom.outbox import encode as encode_outbox_record, picklable
 from voom.priorities import BusPriority  # @UnusedImport
+from voom.timers import HierarchicalTimerWheel, WheelTimer
 
 
 LOG = logging.getLogger(__name__)
 
+# live buses, by key; lets a forked worker process find its copy of a bus.
+_INSTANCES = weakref.WeakValueDictionary()
+
 
 class VoomBus(object):
     """
     A message dispatching service.
+
+    :param local_factory: creates the storage for transaction state and
+       session frames; defaults to thread local storage. Its
+       ``channel_factory``, if any, creates the matching storage for the
+       current thread channel. See :mod:`voom.adaptors.gevent` for greenlet
+       local storage.
+    :param executor: a :class:`concurrent.futures.Executor`; when provided,
+       handlers flagged as ``independent`` run on it, concurrently with the
+       other handlers of the same priority.
+    :param process_executor: a :class:`concurrent.futures.ProcessPoolExecutor`;
+       when provided, handlers flagged with ``process`` run in its worker
+       processes. The pool must fork its workers after the bus and its
+       handlers are set up, and those handlers must be module level
+       functions. Message bodies and session values must be picklable.
+    :param queue_limits: a :class:`voom.context.QueueLimits` bounding the
+       queue of each transaction; unbounded by default.
+
+    Set ``outbox`` to a :class:`voom.outbox.Outbox` to make the messages of
+    transactions, and deferred messages, durable.
     """
 
     # : Key used to subscribe to ALL messages
     ALL = object()
     # : Key used to subscribe to ALL failures
     ERRORS = object()
-
-    def __init__(self, verbose=False, raise_errors=False, loader=None):
+    # : Maximum number of frames formatted into an InvocationFailure; None for all
+    error_stack_limit = None
+    # : Maximum number of stream() producer threads; stream() waits for one to finish
+    max_streams = 16
+
+    def __init__(self, verbose=False, raise_errors=False, loader=None, polymorphic=False,
+                 local_factory=TrxTLS, executor=None, process_executor=None, queue_limits=None):
+        self._local_factory = local_factory
+        self.queue_limits = queue_limits
+        self.executor = executor
+        self.process_executor = process_executor
+        self.metrics = None
+        self.outbox = None
+        self._key = id(self)
+        _INSTANCES[self._key] = self
         self.resetConfig()
         self._verbose = verbose
+        self._polymorphic = polymorphic
         self.raise_errors = raise_errors
-        self._current_thread_channel = CurrentThreadChannel()
+        self._current_thread_channel = getattr(local_factory, 'channel_factory', CurrentThreadChannel)()
+        self._pending_replies = PendingReplies()
+        self._scheduler = None
+        self._scheduler_lock = threading.Lock()
+        self._streams = threading.BoundedSemaphore(self.max_streams)
         if loader:
             self.loader = loader
 
@@ -42,13 +90,18 @@ class VoomBus(object):
         """
         Revert to an uninitialized state. Useful for testing.
         """
-        self._tls = TrxTLS()
+        self._tls = self._local_factory()
         self._global_handlers = []
         self._error_handlers = []
         self._message_handlers = collections.defaultdict(list)
+        self._plans = {}
+        self._generation = 0
+        self._middleware = []
         self._loader = None
         self._loaded = False
         self._load_lock = None
+        self._type_loader = None
+        self._types_loaded = set()
 
     @property
     def loader(self):
@@ -63,7 +116,35 @@ class VoomBus(object):
             raise ValueError("Bus loader already initialized with another value: %s" % self._loader)
         self._loader = value
         self._loaded = False
-        self._load_lock = threading.RLock()
+        self._load_lock = self._load_lock or threading.RLock()
+
+    @property
+    def type_loader(self):
+        """A callable that will discover the handlers for one message type; it is
+        called with each type the first time a message of that type is dispatched.
+        Defaults to None."""
+        return self._type_loader
+
+    @type_loader.setter
+    def type_loader(self, value):
+        if self._type_loader == value:
+            return
+        if self._type_loader:
+            raise ValueError("Bus type loader already initialized with another value: %s" % self._type_loader)
+        self._type_loader = value
+        self._types_loaded = set()
+        self._load_lock = self._load_lock or threading.RLock()
+
+    @property
+    def polymorphic(self):
+        """When True, handlers subscribed to a class also receive instances
+        of its subclasses. Defaults to False (exact type matching)."""
+        return self._polymorphic
+
+    @polymorphic.setter
+    def polymorphic(self, value):
+        self._polymorphic = bool(value)
+        self._invalidate()
 
     @property
     def trx(self):
@@ -88,14 +169,11 @@ class VoomBus(object):
     def frame(self):
         return self._tls.stack.frame
 
-    @contextmanager
     def using(self, data):
         """Provide a context manager for forwarding data to sessions or messages that will be sent
         or updating the session during a transaction
         """
-        with self._tls.stack.push_frame() as f:
-            f.update(data)
-            yield
+        return self._tls.stack.push_frame(data=data)
 
     @contextmanager
     def transaction(self):
@@ -118,15 +196,128 @@ class VoomBus(object):
             return
 
         try:
-            self.trx.begin()
+            self._begin(self.trx)
             yield False, self.trx
         finally:
-            self._consume()
+            try:
+                self._write_outbox(self.trx.pending_items())
+            finally:
+                self._consume()
 
     def publish(self, body, priority=None):
         self._load()
         self._send_message(MessageEnvelope(body, self.session), priority)
 
+    def publish_many(self, bodies, priority=None):
+        """Publish each of the bodies, in order. The outcome is the same as calling
+        publish() for each, but the loader check, transaction setup and teardown
+        are paid once for the whole batch."""
+        self._load()
+        session = self.session
+        envelopes = (MessageEnvelope(body, session) for body in bodies)
+        trx = self.trx
+        if trx.is_running():
+            for envelope in envelopes:
+                trx.enqueue(envelope, priority)
+            return
+        self._consume(envelopes, priority)
+
+    def publish_at(self, body, when, priority=None):
+        """Publish body at the given time, in seconds since the epoch, in the
+        current session. Returns a handle for cancel_scheduled().
+
+        Scheduled messages are kept in memory on a hierarchical timing wheel, and
+        published from a scheduler thread, apart from the one advancing the wheel;
+        the messages that fall due together are published in one transaction.
+        """
+        self._load()
+        with self._scheduler_lock:
+            if self._scheduler is None:
+                self._scheduler = WheelTimer(self._publish_due, HierarchicalTimerWheel(),
+                                             name="voom-scheduler")
+        return self._scheduler.schedule(when, (MessageEnvelope(body, self.session), priority))
+
+    def publish_after(self, body, delay, priority=None):
+        """Publish body in delay seconds; see publish_at()."""
+        return self.publish_at(body, time.time() + delay, priority)
+
+    def cancel_scheduled(self, handle):
+        """Cancel a scheduled message; returns False if it was already published or cancelled."""
+        if self._scheduler is None:
+            return False
+        return self._scheduler.cancel(handle)
+
+    def _publish_due(self, due):
+        with self.transaction() as (_, trx):
+            for envelope, priority in due:
+                trx.enqueue(envelope, priority)
+
+    def request(self, body, timeout=None, priority=None):
+        """Publish body, and return a :class:`voom.local.ReplyFuture` for the first
+        reply to it. The session carries a correlation id, and a reply address
+        unique to this request. If no reply arrives within timeout seconds, the
+        future fails with :class:`voom.exceptions.RequestTimeout`.
+
+        >>> price = bus.request(GetQuote(sku), timeout=2).result()
+
+        A handler that replies while the message is dispatched resolves the
+        future before request() returns; replies may also come later, from
+        other threads, with a context obtained from get_reply_context().
+        """
+        replies = self._pending_replies
+        future = replies.open(timeout)
+        try:
+            with self.using({SessionKeys.CORRELATION_ID: future.correlation_id,
+                             SessionKeys.REPLY_TO: replies.address(future),
+                             SessionKeys.RESPONDER: replies}):
+                self.publish(body, priority)
+        except:
+            replies.cancel(future)
+            raise
+        return future
+
+    def stream(self, body, maxsize=64, priority=None, timeout=60):
+        """Publish body on a new thread, with a :class:`voom.local.StreamingChannel`
+        as its reply address, and return the channel. Iterating over it yields
+        the replies and forwarded messages as the handlers send them; the
+        handlers wait whenever maxsize messages are waiting to be consumed, for
+        at most timeout seconds, after which the channel is closed and further
+        replies are discarded.
+
+        >>> for reply in bus.stream(ExportRows(query)):
+        ...     response.write(render(reply))
+
+        Errors that escape publish, such as a BusError, are raised from the
+        iteration once the replies sent before them have been consumed. At
+        most ``max_streams`` producers run at once; stream() waits for one of
+        them to finish beyond that.
+        """
+        channel = StreamingChannel(maxsize, timeout)
+        frame = self.session.extend()
+        frame.update({SessionKeys.REPLY_TO: StreamingChannel.ADDRESS,
+                      SessionKeys.RESPONDER: channel})
+
+        def produce():
+            try:
+                with self._tls.stack.push_frame(frame):
+                    self.publish(body, priority)
+            except Exception:
+                channel.finish(sys.exc_info())
+            else:
+                channel.finish()
+            finally:
+                self._streams.release()
+
+        self._streams.acquire()
+        try:
+            producer = threading.Thread(target=produce, name="voom-stream")
+            producer.daemon = True
+            producer.start()
+        except:
+            self._streams.release()
+            raise
+        return channel
+
     def defer(self, msg):
         """Enqueue a message that is sent contingent on the current message
         completing all handlers without aborting."""
@@ -202,6 +393,7 @@ class VoomBus(object):
             LOG.info("callback %s re-registered with new priority. old=%s, new=%s",
                      _callback, _priority, priority)
         bisect.insort(handlers, (priority, callback))
+        self._invalidate()
         LOG.debug("Updated handlers: %s", handlers)
 
     def unsubscribe(self, message_type, callback):
@@ -210,6 +402,7 @@ class VoomBus(object):
         for priority, cb in handlers:
             if cb == callback:
                 handlers.remove((priority, callback))
+                self._invalidate()
                 return
         raise ValueError("callback not found")
 
@@ -217,83 +410,312 @@ class VoomBus(object):
         """Injection point for doing special things before or after the callback."""
         callback(message_envelope.body)
 
+    def add_middleware(self, middleware):
+        """Wrap every handler invocation with a middleware. A middleware is called
+        as ``middleware(invoke, callback)`` once per handler, when the dispatch plan
+        is built, and returns the callable that takes the message envelope in place
+        of ``invoke``; returning ``invoke`` itself leaves that handler unwrapped.
+
+        The first middleware added is the outermost.
+        """
+        self._middleware.append(middleware)
+        self._invalidate()
+
+    def remove_middleware(self, middleware):
+        self._middleware.remove(middleware)
+        self._invalidate()
+
+    def enable_metrics(self, metrics=None):
+        """Start collecting per message type and per handler call counts, errors
+        and latencies; see :class:`voom.metrics.DispatchMetrics`. Handlers run in
+        a process executor are not measured."""
+        self.metrics = metrics or DispatchMetrics()
+        self._invalidate()
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self._invalidate()
+
+    def _compile(self, callback):
+        """Compose the invocation chain of a handler."""
+        chain = functools.partial(self.invoke, callback)
+        if self.metrics is not None:
+            chain = self.metrics(chain, callback)
+        for middleware in reversed(self._middleware):
+            chain = middleware(chain, callback)
+        return chain
+
     def _send_message(self, message, priority=None):
-        # if the queue is not empty, we are in a transaction,
-        # so queue it up and it will be processed in the invoking loop.
-        self.trx.enqueue(message, priority)
+        # if we are in a transaction, queue it up
+        # and it will be processed in the invoking loop.
+        trx = self.trx
+        if trx.is_running():
+            trx.enqueue(message, priority)
+            return
+        self._consume((message,), priority)
 
-        if self.trx.is_running():
+    def _begin(self, trx):
+        trx.begin()
+        if self.queue_limits is not None:
+            trx.limits = self.queue_limits
+            trx.relieve = self._relieve
+
+    def _relieve(self, trx, size):
+        """Under the BLOCK overflow policy, dispatch queued messages on the
+        publisher's stack until there is room for a message of the given size."""
+        stack = self._tls.stack
+        frame, current, deferred = stack.frame, trx.current_message, trx._deferred
+        trx._deferred = collections.deque()
+        try:
+            while trx.is_over_limits(1, size) and not trx.is_queue_empty():
+                msg = trx.pop()
+                trx.current_message = msg
+                stack.frame = msg.context
+                self._dispatch(msg)
+        finally:
+            stack.frame, trx.current_message, trx._deferred = frame, current, deferred
+
+    def _write_outbox(self, items):
+        """Durably record the (envelope, priority) pairs about to be queued;
+        they are acknowledged when the transaction has consumed them."""
+        if self.outbox is None or not items:
             return
-        self._consume()
+        ids = self.outbox.append([encode_outbox_record(e, p) for e, p in items])
+        self.trx.outboxed.extend(ids)
 
-    def _consume(self):
+    def _consume(self, batch=(), priority=None):
         # this must be absolutely bullet proof
         # and we must leave this function with an
         # empty queue or we corrupt the bus.
         trx = self.trx
-        trx.begin()
+        self._begin(trx)
         msg = None
+        # batched envelopes are fed one at a time, once the queue
+        # has drained, to preserve the ordering of sequential publishes.
+        batch = iter(batch)
+        stack = self._tls.stack
+        parent = stack.frame
         try:
-            for msg in trx.consume_messages():
-                self.trx.current_message = msg
-                with self._tls.stack.push_frame(msg.context):
-                    self._dispatch(msg)
+            while True:
+                for msg in trx.consume_messages():
+                    trx.current_message = msg
+                    stack.frame = msg.context
+                    try:
+                        self._dispatch(msg)
+                    finally:
+                        stack.frame = parent
+                envelope = next(batch, None)
+                if envelope is None:
+                    break
+                trx.enqueue(envelope, priority)
+            if trx.outboxed:
+                self.outbox.ack(trx.outboxed)
         except Exception, e:
             if self.raise_errors:
                 raise
             raise BusError, (msg, e), sys.exc_info()[2] #@IgnorePep8
         finally:
-            self.trx.current_message = None
+            trx.current_message = None
             if not trx.is_queue_empty():
                 LOG.error("Exiting send with queued item; something is terminally wrong.")
+            if trx.limits is not None:
+                trx.limits.observe(trx)
             self._tls.clear()
 
-    def _dispatch(self, message, queue=None):
+    def _dispatch(self, message, queue=None, errors=False):
         if queue == None:
-            queue = list(heapq.merge(self._global_handlers, self._message_handlers[type(message.body)]))
+            queue = self._get_plan(type(message.body))
+        if queue.__class__ is _IndexedPlan:
+            queue = queue.select(message.body)
         try:
-            for priority, callback in queue:
-                try:
-                    if self._verbose:
-                        LOG.debug("invoking %s (priority=%s): %s", callback, priority, message)
-                    self.invoke(callback, message)
-                except AbortProcessing:
-                    raise
-                except Exception, ex:
-                    LOG.exception("Callback failed: %s. Failed to send message: %s", callback, message)
-                    if self.raise_errors:
-                        raise
-                    # avoid a circular loop
-                    if queue == self._error_handlers:
-                        continue
+            if (self.executor is not None or self.process_executor is not None) and not errors:
+                self._dispatch_bands(message, queue)
+            else:
+                for priority, callback, invoke in queue:
                     try:
-                        self._send_error(message, callback, ex)
+                        if self._verbose:
+                            LOG.debug("invoking %s (priority=%s): %s", callback, priority, message)
+                        invoke(message)
                     except AbortProcessing:
                         raise
-                    except:
-                        LOG.exception("Failed to send error. This generally should not happen.")
+                    except Exception, ex:
+                        self._handle_failure(message, callback, ex, errors)
 
         except AbortProcessing:
             LOG.info("processing aborted.""")
-            self.trx._deferred = []
+            self.trx._deferred.clear()
             return
 
-        while self.trx._deferred:
-            LOG.info("sending queued_message")
-            self._send_message(self.trx._deferred.pop(0))
+        trx = self.trx
+        deferred = trx._deferred
+        if not deferred:
+            return
+        trx._deferred = collections.deque()
+        LOG.info("sending %d deferred messages", len(deferred))
+        if self.outbox is not None:
+            self._write_outbox([(envelope, None) for envelope in deferred])
+        if trx.is_running():
+            trx.enqueue_many(deferred)
+        else:
+            self._consume(deferred)
+
+    def _dispatch_bands(self, message, queue):
+        """Dispatch using the executors. Handlers flagged as independent or process
+        run on the thread or process executor, concurrently with the rest of their
+        priority band; each band completes before the next begins."""
+        for priority, band in itertools.groupby(queue, operator.itemgetter(0)):
+            pending = []
+            aborted = False
+            try:
+                for _, callback, invoke in band:
+                    if self._verbose:
+                        LOG.debug("invoking %s (priority=%s): %s", callback, priority, message)
+                    try:
+                        future = self._submit(callback, invoke, message)
+                    except Exception, ex:
+                        self._handle_failure(message, callback, ex)
+                        continue
+                    if future is not None:
+                        pending.append((callback, future))
+                        continue
+                    try:
+                        invoke(message)
+                    except AbortProcessing:
+                        raise
+                    except Exception, ex:
+                        self._handle_failure(message, callback, ex)
+            except AbortProcessing:
+                aborted = True
+            # always wait out the band, even when aborting.
+            for callback, future in pending:
+                try:
+                    queued, deferred, replies = future.result()
+                except AbortProcessing:
+                    aborted = True
+                except Exception, ex:
+                    self._handle_failure(message, callback, ex)
+                else:
+                    for envelope, _priority in queued:
+                        self.trx.enqueue(envelope, _priority)
+                    self.trx._deferred.extend(deferred)
+                    for reply in replies:
+                        self._current_thread_channel(CurrentThreadChannel.ADDRESS, reply)
+            if aborted:
+                raise AbortProcessing()
+
+    def _submit(self, callback, invoke, message):
+        """Hand the callback to an executor, if it asks for one and one is configured."""
+        if self.process_executor is not None and getattr(callback, '_process', False):
+            # pickle here: the pool pickles on a feeder thread, which only logs
+            # failures, leaving the future unresolved.
+            session = message.context.flatten()
+            try:
+                payload = pickle.dumps((callback, message.body, session), pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError):
+                payload = pickle.dumps((callback, message.body,
+                                        picklable(session, "process handler session")),
+                                       pickle.HIGHEST_PROTOCOL)
+            return self.process_executor.submit(_invoke_in_process, self._key, payload)
+        if self.executor is not None and getattr(callback, '_independent', False):
+            return self.executor.submit(self._invoke_detached, invoke, message)
+        return None
+
+    def _invoke_detached(self, invoke, message):
+        """Invoke a handler's chain on an executor thread. The message's session frame
+        is carried over, and anything the handler publishes, defers or replies on
+        the thread channel is captured and returned for the dispatching transaction
+        to replay."""
+        tls = self._tls
+        tls.state = trx = CapturingTrxState()
+        trx.begin()
+        trx.current_message = message
+        channel = self._current_thread_channel
+        channel.pop_all()
+        try:
+            with tls.stack.push_frame(message.context):
+                invoke(message)
+            return trx.captured, trx._deferred, channel.pop_all()
+        finally:
+            channel.pop_all()
+            tls.clear()
+
+    def _handle_failure(self, message, callback, ex, errors=False):
+        LOG.exception("Callback failed: %s. Failed to send message: %s", callback, message)
+        if self.raise_errors:
+            raise
+        # avoid a circular loop
+        if errors:
+            return
+        try:
+            self._send_error(message, callback, ex)
+        except AbortProcessing:
+            raise
+        except:
+            LOG.exception("Failed to send error. This generally should not happen.")
 
     def _send_error(self, message, source, exception=None, tb=None):
-        if exception:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            tb = "\n".join(traceback.format_exception(exc_type, exc_value, exc_traceback)[2:])
-            # find out where send was called from:
-        context = traceback.format_stack()[::-1]
-        while "/voom/" in context[0]:
-            context.pop(0)
-
-        failure = InvocationFailure(message.body, exception, tb, context[::-1])
+        if not self._error_handlers:
+            return
+        exc_info = sys.exc_info() if exception else None
+        failure = InvocationFailure(message.body, exception, tb,
+                                    exc_info=exc_info,
+                                    stack=snapshot_stack(sys._getframe(1), self.error_stack_limit),
+                                    limit=self.error_stack_limit)
         env = MessageEnvelope(failure, message.context)
-        self._dispatch(env, queue=self._error_handlers)
+        self._dispatch(env, self._get_plan(self.ERRORS), errors=True)
+
+    def _get_plan(self, message_type):
+        """Returns the merged, immutable sequence of (priority, callback, invoke)
+        for a message type, invoke being the handler's compiled chain. When some
+        of the handlers declare field filters, it is an :class:`_IndexedPlan`
+        that selects that sequence for each message. Plans are cached until
+        the subscriptions or middleware change."""
+        try:
+            return self._plans[message_type]
+        except KeyError:
+            pass
+        if self._type_loader and message_type not in self._types_loaded and message_type is not self.ERRORS:
+            self._load_type(message_type)
+        generation = self._generation
+        if message_type is self.ERRORS:
+            handlers = self._error_handlers
+        elif self._polymorphic:
+            handlers = self._resolve_mro(message_type)
+        else:
+            handlers = heapq.merge(self._global_handlers,
+                                   self._message_handlers.get(message_type, ()))
+        plan = tuple((priority, callback, self._compile(callback))
+                     for priority, callback in handlers)
+        if any(getattr(callback, '_where', None) for _, callback, _ in plan):
+            plan = _IndexedPlan(plan)
+        # a subscription changed while we were building; don't cache a stale plan.
+        if generation == self._generation:
+            self._plans[message_type] = plan
+        return plan
+
+    def _resolve_mro(self, message_type):
+        """Merge the handlers of every class in the type's MRO. A callback
+        subscribed to several of those classes is invoked once, at its
+        highest priority."""
+        queues = [self._global_handlers]
+        for klass in inspect.getmro(message_type):
+            handlers = self._message_handlers.get(klass)
+            if handlers:
+                queues.append(handlers)
+        plan = []
+        seen = []
+        for priority, callback in heapq.merge(*queues):
+            if callback in seen:
+                continue
+            seen.append(callback)
+            plan.append((priority, callback))
+        return plan
+
+    def _invalidate(self):
+        """Discard all cached dispatch plans."""
+        self._generation += 1
+        self._plans = {}
 
     def _get_handlers(self, message_type):
         if message_type is self.ALL:
@@ -320,3 +742,76 @@ class VoomBus(object):
             finally:
                 self._loaded = True
 
+    def _load_type(self, message_type):
+        with self._load_lock:
+            if message_type in self._types_loaded:
+                return
+            try:
+                LOG.debug("running type loader for %s...", message_type)
+                self._type_loader(message_type)
+            except:
+                LOG.exception("Failed to run type loader for %s!", message_type)
+                raise
+            finally:
+                self._types_loaded.add(message_type)
+
+
+class _IndexedPlan(object):
+    """A dispatch plan for a message type some of whose handlers declare field
+    filters. Each filtered field has a hash index from value to the handlers
+    accepting it, so a message selects its handlers with one lookup per
+    field, and handlers that don't match are never called."""
+    __slots__ = ('entries', 'unfiltered', 'unfiltered_positions', 'indexes', 'required')
+
+    def __init__(self, entries):
+        self.entries = entries
+        unfiltered = []
+        self.indexes = {}
+        # position of a filtered handler -> the number of fields it filters on
+        self.required = {}
+        for position, (_, callback, _) in enumerate(entries):
+            where = getattr(callback, '_where', None)
+            if not where:
+                unfiltered.append(entries[position])
+                continue
+            self.required[position] = len(where)
+            for field, values in where.iteritems():
+                index = self.indexes.setdefault(field, {})
+                for value in values:
+                    index.setdefault(value, []).append(position)
+        self.unfiltered = tuple(unfiltered)
+        self.unfiltered_positions = [p for p in xrange(len(entries)) if p not in self.required]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def select(self, body):
+        """Returns the plan entries for this message, in order."""
+        matched = {}
+        for field, index in self.indexes.iteritems():
+            try:
+                positions = index.get(getattr(body, field), ())
+            except (AttributeError, TypeError):
+                continue
+            for position in positions:
+                matched[position] = matched.get(position, 0) + 1
+        required = self.required
+        matched = [p for p, n in matched.iteritems() if n == required[p]]
+        if not matched:
+            return self.unfiltered
+        entries = self.entries
+        return tuple(entries[p] for p in sorted(matched + self.unfiltered_positions))
+
+
+def _invoke_in_process(key, payload):
+    """Runs in a process pool worker: invoke the callback on the worker's copy
+    of the bus, and return what it published or deferred."""
+    bus = _INSTANCES.get(key)
+    if bus is None:
+        raise InvalidStateError("bus %s is not available in this process; "
+                                "the process pool must fork after the bus is created" % key)
+    callback, body, session = pickle.loads(payload)
+    return bus._invoke_detached(bus._compile(callback), MessageEnvelope(body, ChainedDict(session)))
@@ -1,28 +1,238 @@
-from collections import namedtuple
-from contextlib import contextmanager
+from collections import deque, namedtuple
+import cPickle as pickle
 import heapq
+import itertools
+import linecache
+from logging import getLogger
+import sys
+import tempfile
 import threading
 import time
+import traceback
+
+from voom.exceptions import QueueFull
+
+LOG = getLogger(__name__)
 
 """A wrapper passed internally by the bus."""
 
 MessageEnvelope = namedtuple("MessageEnvelope", ["body", "context"])
 
-"""A container for details about a message + failed handler"""
-InvocationFailure = namedtuple("InvocationFailure", ["message", "exception", "stack_trace", "invocation_context"])
+
+class InvocationFailure(object):
+    """A container for details about a message + failed handler.
+
+    The stack trace and the invocation context may be given as the raw
+    ``sys.exc_info()`` and a stack from :func:`snapshot_stack`, in which
+    case they are only formatted when first accessed. It still behaves as
+    the ``(message, exception, stack_trace, invocation_context)`` tuple it
+    used to be: it can be unpacked, indexed and compared, and it pickles
+    with both formatted.
+    """
+    __slots__ = ('message', 'exception', '_stack_trace', '_invocation_context',
+                 '_exc_info', '_stack', '_limit')
+    _fields = ("message", "exception", "stack_trace", "invocation_context")
+
+    def __init__(self, message, exception, stack_trace=None, invocation_context=None,
+                 exc_info=None, stack=None, limit=None):
+        self.message = message
+        self.exception = exception
+        self._stack_trace = stack_trace
+        self._invocation_context = invocation_context
+        self._exc_info = exc_info
+        self._stack = stack
+        self._limit = limit
+
+    @property
+    def stack_trace(self):
+        if self._exc_info is not None:
+            # skip the header and the bus frame that invoked the handler.
+            lines = traceback.format_exception(*self._exc_info, limit=self._limit)
+            self._stack_trace = "\n".join(lines[2:])
+            self._exc_info = None
+        return self._stack_trace
+
+    @property
+    def invocation_context(self):
+        if self._stack is not None:
+            self._invocation_context = traceback.format_list(
+                [(filename, lineno, name, linecache.getline(filename, lineno).strip() or None)
+                 for filename, lineno, name in self._stack])
+            self._stack = None
+        return self._invocation_context
+
+    def _astuple(self):
+        return (self.message, self.exception, self.stack_trace, self.invocation_context)
+
+    def _asdict(self):
+        return dict(zip(self._fields, self._astuple()))
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return self._astuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, InvocationFailure):
+            other = other._astuple()
+        return self._astuple() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __reduce__(self):
+        return (InvocationFailure, self._astuple())
+
+    def __repr__(self):
+        return "InvocationFailure(message=%r, exception=%r)" % (self.message, self.exception)
+
+
+def snapshot_stack(frame, limit=None):
+    """Where a message was sent from: the (filename, lineno, name) of the frames
+    calling frame, outermost first and skipping the bus itself, for
+    :class:`InvocationFailure` to format when it is needed."""
+    while frame is not None and "/voom/" in frame.f_code.co_filename:
+        frame = frame.f_back
+    stack = []
+    while frame is not None and (limit is None or len(stack) < limit):
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
 
 ReplyContext = namedtuple("ReplyContext", ["reply_to", "responder", "thread_channel"])
 
 
+class QueueLimits(object):
+    """Bounds on the depth, and the estimated memory, of a transaction's
+    queue, and what happens to a message that would exceed them:
+
+    ``BLOCK``
+        the publisher waits while the bus dispatches queued messages, in
+        order and on the publisher's stack, until the queue is back within
+        its limits.
+    ``RAISE``
+        publishing raises :class:`voom.exceptions.QueueFull`.
+    ``SPILL``
+        the message's body is pickled to a temporary file until its turn.
+    ``DROP_LOWEST``
+        the message that would be consumed last, which may be the new one,
+        is discarded and logged.
+
+    The limits also keep high-water marks across all the transactions that
+    use them, for monitoring.
+
+    :param sizeof: estimates the memory used by a message body; it must
+       return the same value every time for a given body.
+    :param spill_dir: where ``SPILL`` creates its files.
+    """
+    BLOCK = 'block'
+    RAISE = 'raise'
+    SPILL = 'spill'
+    DROP_LOWEST = 'drop_lowest'
+    POLICIES = (BLOCK, RAISE, SPILL, DROP_LOWEST)
+
+    def __init__(self, max_depth=None, max_bytes=None, policy=RAISE,
+                 sizeof=sys.getsizeof, spill_dir=None):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown overflow policy %r" % (policy,))
+        if max_depth is not None and max_depth < 1:
+            raise ValueError("max_depth must be at least 1")
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sizeof = sizeof
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, state):
+        """Fold in the marks and counts of a finished transaction."""
+        with self._lock:
+            self.high_water = max(self.high_water, state.high_water)
+            self.high_water_bytes = max(self.high_water_bytes, state.high_water_bytes)
+            self.overflows += state.overflows
+            self.dropped += state.dropped
+            self.spilled += state.spilled
+
+    def snapshot(self):
+        with self._lock:
+            return dict(high_water=self.high_water,
+                        high_water_bytes=self.high_water_bytes,
+                        overflows=self.overflows,
+                        dropped=self.dropped,
+                        spilled=self.spilled)
+
+    def reset(self):
+        with self._lock:
+            self.high_water = 0
+            self.high_water_bytes = 0
+            self.overflows = 0
+            self.dropped = 0
+            self.spilled = 0
+
+
+def _body(message):
+    return message.body if isinstance(message, MessageEnvelope) else message
+
+
+class _Spilled(object):
+    """Holds the place, in its bucket, of a message whose body was spilled to disk."""
+    __slots__ = ('offset', 'context')
+
+    def __init__(self, offset, context):
+        self.offset = offset
+        self.context = context
+
+
 class TrxState(object):
-    """A thread local state object."""
+    """A thread local state object.
+
+    Messages queued with a priority are kept in a deque per priority, and
+    messages queued without one in a FIFO lane, numbered in the order they
+    were queued. The next message is the lowest of the lane's next number
+    and the lowest priority, so a message without a priority ranks like
+    one with its number as priority; on a tie the prioritized message goes
+    first. Messages of equal rank are consumed in the order they were
+    queued, and are never compared.
+    """
 
-    def __init__(self):
+    def __init__(self, limits=None):
         self.current_message = None
-        self._deferred = []
-        self._queued_messages = []
+        # messages deferred by the handlers of the current message
+        self._deferred = deque()
+        # priority -> deque of queued messages
+        self._buckets = {}
+        # a heap of the priorities whose buckets are not empty
+        self._levels = []
+        # (number, message) pairs of the messages queued without a priority
+        self._lane = deque()
         self._indx = 1
+        self._size = 0
         self._started = None
+        # ids of outbox records to acknowledge once consumed
+        self.outboxed = []
+        self.limits = limits
+        # called with this state and the size of the message waiting to be
+        # queued, to make room for it under the BLOCK policy.
+        self.relieve = None
+        self.high_water = 0
+        self.high_water_bytes = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._bytes = 0
+        # the number of queued messages whose bodies are in the spill file
+        self._spilled_count = 0
+        self._spill_file = None
 
     def begin(self):
         self._started = time.time()
@@ -32,78 +242,355 @@ class TrxState(object):
 
     def consume_messages(self):
         """A destructive iterator for consuming all queued messages."""
-        while self._queued_messages:
-            yield heapq.heappop(self._queued_messages)[1]
+        if self.limits is None:
+            next_message = self._next
+            while self._size:
+                yield next_message()
+            return
+        while self._size:
+            yield self.pop()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def _next(self):
+        levels = self._levels
+        lane = self._lane
+        if lane and (not levels or lane[0][0] < levels[0]):
+            message = lane.popleft()[1]
+        else:
+            bucket = self._buckets[levels[0]]
+            message = bucket.popleft()
+            if not bucket:
+                heapq.heappop(levels)
+        self._size -= 1
+        return message
+
+    def pop(self):
+        """Remove and return the next message."""
+        message = self._next()
+        if message.__class__ is _Spilled:
+            self._spilled_count -= 1
+            return self._load_spilled(message)
+        if self._bytes:
+            self._bytes -= self.limits.sizeof(_body(message))
+        return message
+
+    def pending(self):
+        """The queued messages, in the order they will be consumed."""
+        return [message for message, _ in self.pending_items()]
+
+    def pending_items(self):
+        """The (message, priority) pairs queued, in the order they will be consumed;
+        the priority is None for messages queued without one."""
+        ranked = [(priority, 0, i, priority, m) for priority in self._levels
+                  for i, m in enumerate(self._buckets[priority])]
+        ranked.extend((indx, 1, i, None, m) for i, (indx, m) in enumerate(self._lane))
+        ranked.sort(key=lambda r: r[:3])
+        return [(self._load_spilled(m) if m.__class__ is _Spilled else m, priority)
+                for _, _, _, priority, m in ranked]
 
     def size(self):
-        return len(self._queued_messages)
+        return self._size
 
     def is_queue_empty(self):
         """Got messages?"""
         return not bool(self.size())
 
+    def is_over_limits(self, depth=0, size=0):
+        """Would the queue exceed its limits with depth more messages of size more bytes?"""
+        limits = self.limits
+        if limits is None:
+            return False
+        return ((limits.max_depth is not None and
+                 self._size - self._spilled_count + depth > limits.max_depth) or
+                (limits.max_bytes is not None and self._bytes + size > limits.max_bytes))
+
     def enqueue(self, message, priority=None):
         """Enqueue a message during this session."""
+        if self.limits is not None:
+            self._enqueue_limited(priority, message)
+            return
+        self._push(priority, message)
+
+    def enqueue_many(self, messages, priority=None):
+        """Enqueue messages, in order, at the same priority."""
+        if self.limits is not None:
+            for message in messages:
+                self._enqueue_limited(priority, message)
+            return
+        if not messages:
+            return
+        if priority is None:
+            first = self._indx + 1
+            self._indx += len(messages)
+            self._lane.extend(itertools.izip(itertools.count(first), messages))
+        else:
+            self._bucket(priority).extend(messages)
+        self._size += len(messages)
+
+    def _push(self, priority, message):
         if priority is None:
             indx = self._indx = self._indx + 1
+            self._lane.append((indx, message))
         else:
-            indx = priority
-        heapq.heappush(self._queued_messages, (indx, message))
+            self._bucket(priority).append(message)
+        self._size += 1
+
+    def _bucket(self, priority):
+        """The bucket of a priority, which is about to receive messages."""
+        bucket = self._buckets.get(priority)
+        if bucket is None:
+            bucket = self._buckets[priority] = deque()
+        if not bucket:
+            heapq.heappush(self._levels, priority)
+        return bucket
+
+    def _enqueue_limited(self, priority, message):
+        limits = self.limits
+        size = limits.sizeof(_body(message)) if limits.max_bytes is not None else 0
+        if self.is_over_limits(1, size):
+            self.overflows += 1
+            if limits.policy == limits.SPILL:
+                self._spill(priority, message)
+                return
+            elif limits.policy == limits.DROP_LOWEST:
+                rank = self._indx + 1 if priority is None else priority
+                while self.is_over_limits(1, size) and self._drop_lowest(rank):
+                    pass
+                if self.is_over_limits(1, size):
+                    self._drop(message)
+                    return
+            elif limits.policy == limits.BLOCK and self.relieve is not None:
+                self.relieve(self, size)
+            else:
+                raise QueueFull("transaction queue is full (%d messages, %d bytes)" %
+                                (self._size, self._bytes))
+        self._push(priority, message)
+        self._bytes += size
+        depth = self._size - self._spilled_count
+        if depth > self.high_water:
+            self.high_water = depth
+        if self._bytes > self.high_water_bytes:
+            self.high_water_bytes = self._bytes
+
+    def _drop_lowest(self, rank):
+        """Drop the last queued message, if it ranks below rank."""
+        levels = self._levels
+        lane = self._lane
+        lowest = max(levels) if levels else None
+        if lane and (lowest is None or lane[-1][0] >= lowest):
+            if lane[-1][0] <= rank:
+                return False
+            message = lane.pop()[1]
+        else:
+            if lowest is None or lowest <= rank:
+                return False
+            bucket = self._buckets[lowest]
+            message = bucket.pop()
+            if not bucket:
+                levels.remove(lowest)
+                heapq.heapify(levels)
+        self._size -= 1
+        if self.limits.max_bytes is not None:
+            self._bytes -= self.limits.sizeof(_body(message))
+        self._drop(message)
+        return True
+
+    def _drop(self, message):
+        LOG.warning("transaction queue is full; dropping %r", message)
+        self.dropped += 1
+
+    def _spill(self, priority, message):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix="voom-spill-", dir=self.limits.spill_dir)
+        f = self._spill_file
+        f.seek(0, 2)
+        offset = f.tell()
+        pickle.dump(_body(message), f, pickle.HIGHEST_PROTOCOL)
+        # the context stays in memory: it is usually shared, and may hold responders.
+        context = message.context if isinstance(message, MessageEnvelope) else _NO_CONTEXT
+        self._push(priority, _Spilled(offset, context))
+        self._spilled_count += 1
+        self.spilled += 1
+
+    def _load_spilled(self, spilled):
+        f = self._spill_file
+        f.seek(spilled.offset)
+        body = pickle.load(f)
+        if spilled.context is _NO_CONTEXT:
+            return body
+        return MessageEnvelope(body, spilled.context)
+
+
+_NO_CONTEXT = object()
+
+
+class CapturingTrxState(TrxState):
+    """A running transaction that records, in order, what is enqueued
+    rather than queueing it, so messages sent on another thread can be
+    handed back to the owning transaction."""
+
+    def __init__(self):
+        super(CapturingTrxState, self).__init__()
+        self.captured = []
+
+    def enqueue(self, message, priority=None):
+        self.captured.append((message, priority))
+
+
+_MISSING = object()
 
 
 class ChainedDict(dict):
+    """A session frame: a dict that falls back to the frames it extends.
+
+    A frame takes a copy-on-write snapshot of everything visible from its
+    parent when it is extended; changes made to an ancestor afterwards are
+    not seen by existing descendants. The snapshot is a short stack of
+    shared layers, about doubling in size from the newest to the oldest, so
+    a lookup probes O(log n) dicts for n entries at any depth, and
+    extending a frame only copies its own items, plus, amortized, O(log n)
+    merges per item.
+    """
+
     def __init__(self, *args, **kwargs):
         self.parent = None
+        # the ancestors' items, as layers of dicts, newest first; shared
+        # between frames, never mutated.
+        self._base = ()
+        # the layers of this frame, built when first extended.
+        self._view = None
         dict.__init__(self, *args, **kwargs)
 
     def __getitem__(self, key):
-        try:
-            return dict.__getitem__(self, key)
-        except KeyError:
-            if self.parent:
-                return self.parent[key]
-            raise
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            for layer in self._base:
+                value = layer.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
+            raise KeyError(key)
+        return value
 
     def __contains__(self, key):
-        try:
-            self[key]
+        if dict.__contains__(self, key):
             return True
-        except KeyError:
-            return False
+        for layer in self._base:
+            if key in layer:
+                return True
+        return False
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
+        value = dict.get(self, key, _MISSING)
+        if value is _MISSING:
+            for layer in self._base:
+                value = layer.get(key, _MISSING)
+                if value is not _MISSING:
+                    return value
             return default
+        return value
+
+    def __setitem__(self, key, value):
+        self._view = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._view = None
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self._view = None
+        dict.update(self, *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._view = None
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        self._view = None
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._view = None
+        return dict.popitem(self)
+
+    def clear(self):
+        self._view = None
+        dict.clear(self)
+
+    def _layers(self):
+        view = self._view
+        if view is None:
+            view = self._base
+            if dict.__len__(self):
+                layer = dict(self)
+                # merge into older layers that are not at least twice as large.
+                while view and len(layer) * 2 >= len(view[0]):
+                    merged = dict(view[0])
+                    merged.update(layer)
+                    layer = merged
+                    view = view[1:]
+                view = (layer,) + view
+            self._view = view
+        return view
+
+    def flatten(self):
+        """Returns a plain dict of everything visible from this frame."""
+        flat = {}
+        for layer in reversed(self._base):
+            flat.update(layer)
+        flat.update(self)
+        return flat
 
     def extend(self):
         d = ChainedDict()
         d.parent = self
+        d._base = self._layers()
         return d
 
 
-class CactusStack:
+class CactusStack(object):
     """
     Between the ChainedDict (frames), and this (stack),
     we implement continuation-esque frame management
 
     See: http://c2.com/cgi/wiki?CactusStack
     """
+    __slots__ = ('frame', 'globals')
 
     def __init__(self):
         self.frame = self.globals = ChainedDict()
 
-    @contextmanager
-    def push_frame(self, f=None):
-        parent = self.frame
-        if f is None:
-            f = parent.extend()
-        self.frame = f
-        try:
-            yield f
-        finally:
-            self.frame = parent
+    def push_frame(self, f=None, data=None):
+        """A context manager that makes f (by default, a new frame extending
+        the current one, updated with data) the current frame."""
+        return _PushFrame(self, f, data)
+
+
+class _PushFrame(object):
+    __slots__ = ('stack', 'frame', 'data', 'parent')
+
+    def __init__(self, stack, frame, data):
+        self.stack = stack
+        self.frame = frame
+        self.data = data
+
+    def __enter__(self):
+        stack = self.stack
+        self.parent = f = stack.frame
+        if self.frame is None:
+            self.frame = f = f.extend()
+            if self.data:
+                f.update(self.data)
+        else:
+            f = self.frame
+        stack.frame = f
+        return f
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stack.frame = self.parent
+        return False
 
 
 class SessionKeys(object):
@@ -122,15 +609,16 @@ class SessionKeys(object):
     REPLY_TO = "_reply_to"
 
 
-class TrxTLS(threading.local):
-    _state = None
-    _stack = None
+class TrxLocal(object):
+    """The transaction state and frame stack of a single execution context.
 
-    @property
-    def stack(self):
-        if not self._stack:
-            self._stack = CactusStack()
-        return self._stack
+    This holds no storage of its own; combine it with a ``local`` implementation
+    (threads, greenlets, ...) to choose what "current" means for the bus.
+    """
+
+    def __init__(self):
+        self.stack = CactusStack()
+        self._state = None
 
     @property
     def state(self):
@@ -139,9 +627,17 @@ class TrxTLS(threading.local):
             self._state = s = TrxState()
         return s
 
+    @state.setter
+    def state(self, value):
+        self._state = value
+
     @state.deleter
     def state(self):
         self._state = None
 
     def clear(self):
         del self.state
+
+
+class TrxTLS(TrxLocal, threading.local):
+    """Thread local transaction state; the bus default."""
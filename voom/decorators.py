@@ -11,16 +11,31 @@ class MessageHandlerWrapper(object):
     
     @param function: the message handler 
     @param receives: a list of types this handler handles. 
+    @param independent: the handler does not depend on the other handlers of its
+        priority, and may run concurrently with them on the bus's executor.
+    @param process: the handler is CPU bound and runs on the bus's process
+        executor, when one is configured.
+
+    Filters declared with where() and where_in() are indexed by the bus, which
+    then only invokes the handler for messages whose fields match. A filter
+    assigned with filter() may test anything, but is called for every message.
     """
 
-    def __init__(self, function, receives=None, priority=None):
+    def __init__(self, function, receives=None, priority=None, independent=False, process=False):
         self._func = function
         self._filter = None
+        # field name -> frozenset of accepted values
+        self._where = {}
         self._receiver_of = receives
         self._priority = priority
+        self._independent = independent
+        self._process = process
         functools.update_wrapper(self, self._func)
 
     def __call__(self, *args, **kwargs):
+        if self._where and not self.matches(args[0]):
+            LOG.debug("fields do not match for %s, skipping", self)
+            return None
         if self._filter:
             if not self._filter(*args, **kwargs):
                 LOG.debug("filter not met for %s, skipping", self)
@@ -28,6 +43,11 @@ class MessageHandlerWrapper(object):
             LOG.debug("filter met for %s", self)
         return self._func(*args, **kwargs)
 
+    def __reduce__(self):
+        # pickle by reference, so decorated module level handlers
+        # can be sent to worker processes.
+        return self.__name__
+
     def __repr__(self):
         return "<MessageHandlerWrapper %s>" % repr(self._func)
 
@@ -35,6 +55,26 @@ class MessageHandlerWrapper(object):
         """Assign a filter to this handler."""
         self._filter = func
 
+    def where(self, **fields):
+        """Only handle messages whose fields equal the given values."""
+        return self.where_in(**dict((k, (v,)) for k, v in fields.iteritems()))
+
+    def where_in(self, **fields):
+        """Only handle messages whose fields are among the given values."""
+        for field, values in fields.iteritems():
+            self._where[field] = frozenset(values)
+        return self
+
+    def matches(self, message):
+        """Do the message's fields satisfy the where() filters?"""
+        for field, values in self._where.iteritems():
+            try:
+                if getattr(message, field) not in values:
+                    return False
+            except (AttributeError, TypeError):
+                return False
+        return True
+
 
 def receiver(*message_types, **kwargs):
     """Provides an easy declaration for what a message handler receives."""
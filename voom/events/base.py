@@ -1,13 +1,61 @@
+import keyword
+import re
+import sys
+
+_TEMPLATE = """\
+def __init__(self%(params)s):
+    %(assignments)s
+
+def _values(self):
+    return (%(values)s)
+"""
+
+
+_SLOT_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
 
 
 class Event(object):
+    __slots__ = ()
+
     def __init__(self, *args):
         for k, v in zip(self.FIELDS, args):
             setattr(self, k, v)
 
     @classmethod
-    def new(cls, name, fields, **kwargs):
-        kwargs['FIELDS'] = fields.split(" ")
+    def new(cls, name, fields, value_hash=False, **kwargs):
+        """Create a new event type with the given space separated fields.
+        Keyword arguments named after a field provide its default, which is
+        otherwise None; the rest become class attributes.
+
+        The generated class stores its fields in slots, and has a specialized
+        constructor and equality. Events hash by identity, as fields may hold
+        unhashable values; with ``value_hash``, they hash by their field
+        values, which must then be hashable.
+        """
+        fields = fields.split()
+        defaults = dict((f, kwargs.pop(f)) for f in fields if f in kwargs)
+        inherited = set()
+        for klass in cls.__mro__:
+            inherited.update(getattr(klass, '__slots__', ()))
+
+        kwargs['FIELDS'] = fields
+        slots = [f for f in fields if f not in inherited]
+        if not all(_SLOT_NAME.match(f) for f in slots):
+            # names that can't be slots, such as "a-b", go in the instance dict.
+            slots = [f for f in slots if _SLOT_NAME.match(f)]
+            if '__dict__' not in inherited:
+                slots.append('__dict__')
+        kwargs['__slots__'] = tuple(slots)
+        kwargs.update(_make_methods(name, fields, defaults))
+        kwargs['_repr_format'] = "%%s(%s)" % ", ".join("%s=%%r" % f for f in fields)
+        methods = ['__eq__', '__ne__', '__repr__', '__reduce__']
+        if value_hash:
+            methods.append('__hash__')
+        for method in methods:
+            kwargs.setdefault(method, getattr(_SlottedEvent, method).im_func)
+        # like namedtuple, attribute the class to the caller's module so that
+        # instances can be pickled.
+        kwargs.setdefault('__module__', sys._getframe(1).f_globals.get('__name__', '__main__'))
         return type(name, (cls,), kwargs)
 
     def __eq__(self, other):
@@ -21,3 +69,66 @@ class Event(object):
     def __repr__(self):
         reprtxt = ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.FIELDS)
         return "%s(%s)" % (self.__class__.__name__, reprtxt)
+
+
+class _SlottedEvent(object):
+    """The methods shared by the classes generated by Event.new."""
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._values() == other._values()
+        return False
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return self._repr_format % ((self.__class__.__name__,) + self._values())
+
+    def __reduce__(self):
+        return (self.__class__, self._values())
+
+
+def _make_methods(name, fields, defaults):
+    """Generate __init__ and _values for the fields, namedtuple style. Field
+    names that can't be parameters, such as ``from``, get generic ones."""
+    if not all(_is_parameter(f) for f in fields):
+        return _generic_methods(fields, defaults)
+    params = []
+    for f in fields:
+        if f in defaults:
+            params.append("%s=_defaults[%r]" % (f, f))
+        else:
+            params.append("%s=None" % f)
+    source = _TEMPLATE % dict(params="".join(", " + p for p in params),
+                              assignments="\n    ".join("self.%s = %s" % (f, f) for f in fields) or "pass",
+                              values="".join("self.%s, " % f for f in fields))
+    namespace = {'_defaults': defaults}
+    exec source in namespace
+    return dict(__init__=namespace['__init__'], _values=namespace['_values'])
+
+
+def _is_parameter(field):
+    return bool(_SLOT_NAME.match(field)) and not keyword.iskeyword(field) and field != 'self'
+
+
+def _generic_methods(fields, defaults):
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(fields):
+            raise TypeError("%s takes at most %d arguments (%d given)"
+                            % (self.__class__.__name__, len(fields), len(args)))
+        values = dict(zip(fields, args))
+        for f, v in kwargs.iteritems():
+            if f not in fields or f in values:
+                raise TypeError("%s got an unexpected or repeated argument %r"
+                                % (self.__class__.__name__, f))
+            values[f] = v
+        for f in fields:
+            setattr(self, f, values[f] if f in values else defaults.get(f))
+
+    def _values(self):
+        return tuple(getattr(self, f) for f in fields)
+    return dict(__init__=__init__, _values=_values)
@@ -24,3 +24,14 @@ class InvalidAddressError(Exception):
 
 class InvalidStateError(ValueError):
     pass
+
+
+class QueueFull(Exception):
+    """Raised when a message is published onto a transaction queue that has
+    reached its :class:`voom.context.QueueLimits`."""
+    pass
+
+
+class RequestTimeout(Exception):
+    """No reply to a request arrived in time."""
+    pass
@@ -1,15 +1,23 @@
+import collections
+import itertools
 from logging import getLogger
 import re
 import sys
 import threading
+import time
 import urlparse
+import uuid
+
+from voom.exceptions import RequestTimeout
+from voom.timers import TimerWheel, WheelTimer
 
 LOG = getLogger("voom.channels")
 
 
-class CurrentThreadChannel(threading.local):
-    """Provides a mechanism for collecting messages in the current thread
-    for later processing."""
+class LocalChannel(object):
+    """Collects the messages sent to it in the current execution context, for
+    later processing. This holds no storage of its own; combine it with a
+    ``local`` implementation, as :class:`CurrentThreadChannel` does."""
 
     SCHEME = "thread+current"
     ADDRESS = SCHEME + ":"
@@ -29,3 +37,201 @@ class CurrentThreadChannel(threading.local):
             return self.messages
         finally:
             self._messages = []
+
+
+class CurrentThreadChannel(LocalChannel, threading.local):
+    """Provides a mechanism for collecting messages in the current thread
+    for later processing."""
+
+
+class StreamingChannel(object):
+    """A channel that hands messages to a consumer as they are sent, through
+    a bounded buffer: a sender waits while the buffer is full, so replies
+    can be streamed out without being held in memory.
+
+    Iterate over the channel to consume it, usually on another thread than
+    the one sending; see :meth:`voom.bus.VoomBus.stream`. Iteration ends
+    once the sender calls :meth:`finish`, re-raising the error it was given,
+    if any. Abandoning the iteration closes the channel, after which
+    messages sent to it are discarded. So does a sender waiting more than
+    ``timeout`` seconds for room, as when nothing consumes the channel.
+    """
+
+    SCHEME = "stream"
+    ADDRESS = SCHEME + ":"
+
+    def __init__(self, maxsize=0, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._finished = False
+        self._closed = False
+        self._exc_info = None
+
+    def __call__(self, address, message, **kwargs):
+        with self._cond:
+            deadline = None if self.timeout is None else time.time() + self.timeout
+            while self.maxsize and len(self._buffer) >= self.maxsize and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    LOG.warning("stream not consumed for %ss; closing it", self.timeout)
+                    self._closed = True
+                    self._buffer.clear()
+                    self._cond.notify_all()
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                return
+            self._buffer.append(message)
+            self._cond.notify_all()
+
+    def finish(self, exc_info=None):
+        """No more messages will be sent."""
+        with self._cond:
+            self._finished = True
+            self._exc_info = exc_info
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop consuming, releasing any waiting sender."""
+        with self._cond:
+            self._closed = True
+            self._buffer.clear()
+            self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._buffer and not self._finished:
+                        self._cond.wait()
+                    if not self._buffer:
+                        break
+                    message = self._buffer.popleft()
+                    self._cond.notify_all()
+                yield message
+            if self._exc_info is not None:
+                raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        finally:
+            self.close()
+
+
+class ReplyFuture(object):
+    """The eventual reply to a request made with :meth:`voom.bus.VoomBus.request`."""
+
+    def __init__(self, correlation_id):
+        self.correlation_id = correlation_id
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._timer = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the reply, and return it; raises RequestTimeout if the
+        request expired, or if no reply arrives within timeout seconds."""
+        if not self._done.wait(timeout):
+            raise RequestTimeout("no reply to %s within %ss" % (self.correlation_id, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except Exception, e:
+            return e
+
+    def add_done_callback(self, fn):
+        """Call fn with this future once it is done, immediately if it already is."""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        self._run_callbacks([fn])
+
+    def _resolve(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self._run_callbacks(callbacks)
+
+    def _run_callbacks(self, callbacks):
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                LOG.exception("reply callback %s failed", fn)
+
+    def __repr__(self):
+        return "<ReplyFuture %s %s>" % (self.correlation_id, "done" if self.done() else "pending")
+
+
+class PendingReplies(object):
+    """A channel that resolves the futures of outstanding requests. Each request
+    is given the address ``request:<correlation id>``; the first reply sent to
+    it resolves the request's future, and any later one is dropped.
+
+    Timeouts are tracked on a timing wheel, so that each outstanding request
+    costs O(1) to add, resolve and expire.
+    """
+
+    SCHEME = "request"
+
+    def __init__(self, resolution=0.01):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._prefix = uuid.uuid4().hex[:12]
+        self._ids = itertools.count(1)
+        self._timer = WheelTimer(self._expire, TimerWheel(resolution), name="voom-requests")
+
+    def __len__(self):
+        return len(self._pending)
+
+    def open(self, timeout=None):
+        """Start tracking a new request, returning its future."""
+        future = ReplyFuture("%s-%d" % (self._prefix, next(self._ids)))
+        with self._lock:
+            self._pending[future.correlation_id] = future
+        if timeout is not None:
+            future._timer = self._timer.schedule(time.time() + timeout, future.correlation_id)
+        return future
+
+    def address(self, future):
+        return "%s:%s" % (self.SCHEME, future.correlation_id)
+
+    def __call__(self, address, message, **kwargs):
+        correlation_id = address.partition(":")[2]
+        future = self._pop(correlation_id)
+        if future is None:
+            LOG.debug("dropping reply to %s; it was already answered or has expired", address)
+            return
+        if future._timer is not None:
+            self._timer.cancel(future._timer)
+        future._resolve(message)
+
+    def cancel(self, future):
+        """Stop waiting for a reply; returns False if the request was already done."""
+        if self._pop(future.correlation_id) is None:
+            return False
+        if future._timer is not None:
+            self._timer.cancel(future._timer)
+        future._resolve(exception=RequestTimeout("request %s was cancelled" % future.correlation_id))
+        return True
+
+    def _pop(self, correlation_id):
+        with self._lock:
+            return self._pending.pop(correlation_id, None)
+
+    def _expire(self, correlation_ids):
+        for correlation_id in correlation_ids:
+            future = self._pop(correlation_id)
+            if future is not None:
+                future._resolve(exception=RequestTimeout("no reply to request %s" % correlation_id))
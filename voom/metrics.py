@@ -0,0 +1,117 @@
+from bisect import bisect_left
+import threading
+from timeit import default_timer
+
+from voom.exceptions import AbortProcessing
+
+"""Upper bounds, in seconds, of the default latency buckets."""
+DEFAULT_BOUNDS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                  0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Stats(object):
+    """Call and error counts, and a latency histogram, for one key."""
+    __slots__ = ('calls', 'errors', 'total', 'counts')
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        # one count per bound, plus one for everything slower.
+        self.counts = [0] * (buckets + 1)
+
+    def as_dict(self, bounds):
+        return dict(calls=self.calls,
+                    errors=self.errors,
+                    total=self.total,
+                    mean=self.total / self.calls if self.calls else 0.0,
+                    bounds=list(bounds),
+                    counts=list(self.counts))
+
+
+class DispatchMetrics(object):
+    """Collects handler invocation counts, errors and latencies, both per
+    message type and per handler.
+
+    Install on a bus with :meth:`voom.bus.VoomBus.enable_metrics`; the bus
+    then wraps each handler's invocation chain with it, like a middleware.
+    """
+
+    timer = staticmethod(default_timer)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(sorted(bounds))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, invoke, callback):
+        record = self.record
+        timer = self.timer
+
+        def measured(message_envelope):
+            start = timer()
+            try:
+                invoke(message_envelope)
+            except AbortProcessing:
+                record(type(message_envelope.body), callback, timer() - start)
+                raise
+            except:
+                record(type(message_envelope.body), callback, timer() - start, True)
+                raise
+            record(type(message_envelope.body), callback, timer() - start)
+        return measured
+
+    def record(self, message_type, callback, elapsed, failed=False):
+        """Record one invocation of callback for a message of message_type."""
+        bucket = bisect_left(self.bounds, elapsed)
+        with self._lock:
+            for stats, key in ((self._types, message_type), (self._handlers, callback)):
+                s = stats.get(key)
+                if s is None:
+                    s = stats[key] = Stats(len(self.bounds))
+                s.calls += 1
+                s.total += elapsed
+                s.counts[bucket] += 1
+                if failed:
+                    s.errors += 1
+
+    def snapshot(self):
+        """Returns the collected metrics as plain dicts, keyed by the names of
+        the message types and handlers. Handlers that share a name, such as
+        the same method bound to two instances, are told apart by the
+        address of their instance."""
+        with self._lock:
+            return dict(types=self._by_name(self._types),
+                        handlers=self._by_name(self._handlers))
+
+    def _by_name(self, stats):
+        keys = {}
+        for key in stats:
+            keys.setdefault(_name(key), []).append(key)
+        named = {}
+        for name, same in keys.iteritems():
+            if len(same) == 1:
+                named[name] = stats[same[0]].as_dict(self.bounds)
+                continue
+            for key in same:
+                owner = getattr(key, '__self__', None) or key
+                named["%s at 0x%x" % (name, id(owner))] = stats[key].as_dict(self.bounds)
+        return named
+
+    def reset(self):
+        with self._lock:
+            self._types = {}
+            self._handlers = {}
+
+
+def _name(obj):
+    name = getattr(obj, '__name__', None)
+    if name is None or name == '<lambda>':
+        return repr(obj)
+    owner = getattr(obj, '__self__', None)
+    if owner is not None:
+        # a bound method; name it after its class.
+        klass = owner if isinstance(owner, type) else owner.__class__
+        name = "%s.%s" % (klass.__name__, name)
+    module = getattr(obj, '__module__', None)
+    return "%s.%s" % (module, name) if module else name
@@ -0,0 +1,241 @@
+"""Durable storage for the messages of a transaction.
+
+When a bus has an outbox, the messages queued by a transaction are written
+to it as one batch when the transaction commits, as are the messages a
+handler defers once its message completes. They are acknowledged once the
+bus has consumed them; after a crash, :meth:`Outbox.replay` redelivers
+whatever was never acknowledged. Delivery is therefore at-least-once.
+
+Writes use group commit: batches from concurrent transactions that arrive
+while a write is in flight are written, and synced, together.
+"""
+from logging import getLogger
+import cPickle as pickle
+import os
+import struct
+import threading
+
+LOG = getLogger(__name__)
+
+
+def encode(envelope, priority=None):
+    """Serialize a message envelope into an outbox record."""
+    context = envelope.context.flatten() if envelope.context is not None else {}
+    try:
+        return pickle.dumps((envelope.body, context, priority), pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError):
+        # responders and the like can't survive a restart anyway.
+        return pickle.dumps((envelope.body, picklable(context, "outbox record"), priority),
+                            pickle.HIGHEST_PROTOCOL)
+
+
+def picklable(session, destination="pickle"):
+    """The items of a flattened session whose values can be pickled; the
+    others, such as responders, are dropped with a warning."""
+    kept = {}
+    for k, v in session.iteritems():
+        try:
+            pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            LOG.warning("dropping unpicklable session value %r from %s", k, destination)
+            continue
+        kept[k] = v
+    return kept
+
+
+def decode(record):
+    """Returns the (body, session, priority) of an outbox record."""
+    return pickle.loads(record)
+
+
+class _Batch(object):
+    __slots__ = ('records', 'ids', 'error', 'done')
+
+    def __init__(self, records):
+        self.records = records
+        self.ids = None
+        self.error = None
+        self.done = False
+
+
+class Outbox(object):
+    """Base class for outbox backends, which implement _write, ack and pending."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._writing = False
+
+    def append(self, records):
+        """Durably store the records, returning their ids."""
+        if not records:
+            return []
+        batch = _Batch(records)
+        with self._cond:
+            self._waiting.append(batch)
+            while not batch.done:
+                if self._writing:
+                    self._cond.wait()
+                    continue
+                # become the leader, and write everything that's waiting.
+                self._writing = True
+                batches, self._waiting = self._waiting, []
+                self._cond.release()
+                try:
+                    try:
+                        ids = self._write([r for b in batches for r in b.records])
+                    except Exception, e:
+                        for b in batches:
+                            b.error = e
+                    else:
+                        for b in batches:
+                            b.ids, ids = ids[:len(b.records)], ids[len(b.records):]
+                finally:
+                    self._cond.acquire()
+                    self._writing = False
+                    for b in batches:
+                        b.done = True
+                    self._cond.notify_all()
+        if batch.error is not None:
+            raise batch.error
+        return batch.ids
+
+    def _write(self, records):
+        """Durably write the records in one operation, returning their ids."""
+        raise NotImplementedError
+
+    def ack(self, ids):
+        """Mark the records delivered."""
+        raise NotImplementedError
+
+    def pending(self):
+        """Returns a list of (id, record) that have not been acknowledged, oldest first."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def replay(self, bus):
+        """Redeliver every record that was not acknowledged, in order, each in
+        its original session. Returns the number of records replayed."""
+        count = 0
+        for id_, record in self.pending():
+            body, session, priority = decode(record)
+            with bus.using(session):
+                bus.publish(body, priority)
+            self.ack([id_])
+            count += 1
+        return count
+
+
+class SQLiteOutbox(Outbox):
+    """An outbox kept in a SQLite database."""
+
+    def __init__(self, path):
+        super(SQLiteOutbox, self).__init__()
+        import sqlite3
+        self._binary = sqlite3.Binary
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, record BLOB)")
+        self._db.commit()
+
+    def _write(self, records):
+        with self._lock:
+            with self._db:
+                cursor = self._db.cursor()
+                ids = []
+                for record in records:
+                    cursor.execute("INSERT INTO outbox (record) VALUES (?)", (self._binary(record),))
+                    ids.append(cursor.lastrowid)
+                return ids
+
+    def ack(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def pending(self):
+        with self._lock:
+            return [(id_, str(record)) for id_, record in
+                    self._db.execute("SELECT id, record FROM outbox ORDER BY id")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class FileOutbox(Outbox):
+    """An outbox kept in an append-only log file. Each batch is written and
+    fsync'd once; acknowledgements are appended without syncing, since losing
+    one only causes a redelivery. The log is truncated whenever every record
+    has been acknowledged."""
+
+    _HEADER = struct.Struct(">cQI")
+    _APPEND = 'A'
+    _ACK = 'D'
+
+    def __init__(self, path):
+        super(FileOutbox, self).__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        pending = self._read()
+        self._pending = set(pending)
+        self._next_id = max(pending) + 1 if pending else 1
+        self._file = open(path, 'ab')
+
+    def _read(self):
+        pending = {}
+        if not os.path.exists(self.path):
+            return pending
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(self._HEADER.size)
+                if len(header) < self._HEADER.size:
+                    break
+                op, id_, size = self._HEADER.unpack(header)
+                record = f.read(size)
+                if len(record) < size:
+                    # a torn write; its batch was never acknowledged as durable.
+                    break
+                if op == self._APPEND:
+                    pending[id_] = record
+                else:
+                    pending.pop(id_, None)
+        return pending
+
+    def _write(self, records):
+        with self._lock:
+            ids = range(self._next_id, self._next_id + len(records))
+            self._next_id += len(records)
+            self._file.write("".join(self._HEADER.pack(self._APPEND, i, len(r)) + r
+                                     for i, r in zip(ids, records)))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.update(ids)
+            return ids
+
+    def ack(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            self._pending.difference_update(ids)
+            if not self._pending:
+                self._file.truncate(0)
+                self._file.flush()
+                return
+            self._file.write("".join(self._HEADER.pack(self._ACK, i, 0) for i in ids))
+            self._file.flush()
+
+    def pending(self):
+        with self._lock:
+            self._file.flush()
+            return sorted(self._read().iteritems())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,123 @@
+"""Dispatch on several worker threads while keeping the order of related messages.
+
+A :class:`ShardedDispatcher` hashes a key of each message, such as the user
+it concerns, to one of its shards. Every shard is a worker thread that
+publishes its messages on the bus in the order they were given, so the
+messages of one key are handled in order, while the messages of different
+keys are handled in parallel:
+
+>>> shards = ShardedDispatcher(bus, key=attrgetter('user'), shards=8)
+>>> shards.publish(ProfileUpdated(user=42))
+>>> shards.join()
+
+Each worker has its own transaction state and session frames, as does any
+thread that publishes on a bus. This pays off when handlers wait on I/O;
+with CPU bound handlers the GIL serializes the shards.
+"""
+from logging import getLogger
+import itertools
+import Queue
+import threading
+
+LOG = getLogger(__name__)
+
+_STOP = object()
+
+
+class ShardedDispatcher(object):
+    """Publishes messages on a bus from ``shards`` worker threads.
+
+    :param key: returns the key of a message body; messages with equal keys
+       go to the same shard. Defaults to the body itself.
+    :param maxsize: the most messages waiting in a shard's queue; publishing
+       to a full shard blocks. Unbounded by default.
+    :param max_batch: the most messages a worker takes from its queue at
+       once; consecutive messages of a batch with the same session and
+       priority are published with publish_many().
+    """
+
+    def __init__(self, bus, key=None, shards=4, maxsize=0, max_batch=256, name="voom-shard"):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.bus = bus
+        self.key = key
+        self.max_batch = max_batch
+        self._queues = [Queue.Queue(maxsize) for _ in xrange(shards)]
+        self._threads = []
+        for i, queue in enumerate(self._queues):
+            t = threading.Thread(target=self._work, args=(queue,), name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def shards(self):
+        return len(self._queues)
+
+    def shard_of(self, body):
+        """The index of the shard a message body goes to."""
+        key = body if self.key is None else self.key(body)
+        return hash(key) % len(self._queues)
+
+    def publish(self, body, priority=None):
+        """Queue body to be published, in the current session, by its shard."""
+        self._queues[self.shard_of(body)].put((body, self.bus.session, priority))
+
+    def join(self):
+        """Wait until every message queued so far has been handled."""
+        for queue in self._queues:
+            queue.join()
+
+    def close(self):
+        """Handle the messages already queued, then stop the workers."""
+        for queue in self._queues:
+            queue.put(_STOP)
+        for t in self._threads:
+            t.join()
+
+    def _work(self, queue):
+        while True:
+            batch = [queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = _STOP in batch
+            if stop:
+                batch = batch[:batch.index(_STOP)]
+            try:
+                self._publish(batch)
+            finally:
+                for _ in xrange(len(batch) + stop):
+                    queue.task_done()
+            if stop:
+                return
+
+    def _publish(self, batch):
+        stack = self.bus._tls.stack
+        for _, items in itertools.groupby(batch, lambda item: (id(item[1]), item[2])):
+            items = list(items)
+            _, session, priority = items[0]
+            bodies = [body for body, _, _ in items]
+            while bodies:
+                # publish_many takes the bodies one at a time, so when one fails
+                # the count tells where to carry on from.
+                taken = [0]
+
+                def take():
+                    for body in bodies:
+                        taken[0] += 1
+                        yield body
+                try:
+                    with stack.push_frame(session):
+                        self.bus.publish_many(take(), priority)
+                    break
+                except Exception:
+                    if not taken[0]:
+                        # failed before publishing anything, e.g. in the bus loader;
+                        # retrying would fail the same way.
+                        LOG.exception("failed to publish %d messages on a shard", len(bodies))
+                        break
+                    LOG.exception("failed to publish %r on a shard", bodies[taken[0] - 1])
+                    bodies = bodies[taken[0]:]
@@ -0,0 +1,280 @@
+"""Timing wheels, for tracking large numbers of timers that are mostly
+cancelled before they expire, such as request timeouts, or that are due
+far in the future, such as scheduled messages.
+
+A :class:`TimerWheel` divides time into ticks, and hashes each timer into
+the slot of the tick it is due in, so scheduling and cancelling a timer
+are O(1), and advancing the wheel only visits the slots of the ticks that
+elapsed. A :class:`HierarchicalTimerWheel` stacks wheels of coarser ticks
+so that distant timers are only looked at a few times before they are
+due. A :class:`WheelTimer` drives either from a daemon thread.
+"""
+import collections
+from logging import getLogger
+import itertools
+import math
+from operator import attrgetter
+import threading
+import time
+
+LOG = getLogger(__name__)
+
+
+class Timer(object):
+    """A scheduled timer; pass it to cancel()."""
+    __slots__ = ('tick', 'key', 'payload', 'slot', 'level')
+
+    def __init__(self, tick, key, payload, slot, level=0):
+        self.tick = tick
+        # (deadline, sequence), the order timers expiring together are returned in
+        self.key = key
+        self.payload = payload
+        self.slot = slot
+        self.level = level
+
+
+def _expired(timers):
+    timers.sort(key=attrgetter('key'))
+    return [timer.payload for timer in timers]
+
+
+class TimerWheel(object):
+    """A hashed timing wheel, with ticks of ``resolution`` seconds. Timers
+    expire at most one tick late. A slot holds the timers of every tick that
+    hashes to it, so a timer due more than ``slots`` ticks ahead waits in
+    its slot for as many revolutions as it takes.
+
+    Not thread safe.
+    """
+
+    def __init__(self, resolution=0.01, slots=512, now=None):
+        self.resolution = resolution
+        self._slots = [set() for _ in xrange(slots)]
+        now = time.time() if now is None else now
+        # the last tick that has been expired
+        self._tick = int(now / resolution)
+        self._count = 0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, payload):
+        """Schedule payload to expire at deadline, in seconds since the epoch."""
+        tick = max(int(math.ceil(deadline / self.resolution)), self._tick + 1)
+        slot = self._slots[tick % len(self._slots)]
+        timer = Timer(tick, (deadline, next(self._seq)), payload, slot)
+        slot.add(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer; returns False if it had already expired or been cancelled."""
+        if timer.slot is None:
+            return False
+        timer.slot.discard(timer)
+        timer.slot = None
+        self._count -= 1
+        return True
+
+    def advance(self, now):
+        """Expire the timers due by now, returning their payloads in deadline
+        order; timers with the same deadline expire in the order scheduled."""
+        target = int(now / self.resolution)
+        if target <= self._tick:
+            return []
+        expired = []
+        slots = self._slots
+        if target - self._tick >= len(slots):
+            # a full revolution or more has elapsed; every slot is due once.
+            ticks = [self._tick + 1 + i for i in xrange(len(slots))]
+        else:
+            ticks = xrange(self._tick + 1, target + 1)
+        for tick in ticks:
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            due = [timer for timer in slot if timer.tick <= target]
+            for timer in due:
+                slot.discard(timer)
+                timer.slot = None
+            expired.extend(due)
+        self._tick = target
+        self._count -= len(expired)
+        return _expired(expired)
+
+
+class HierarchicalTimerWheel(object):
+    """A timing wheel of ``levels`` wheels of ``slots`` slots each, where a tick
+    of each level spans a full revolution of the level below. A timer goes in
+    the finest level whose revolution covers its deadline, and each time a
+    level completes a revolution the next coarser slot is cascaded, its timers
+    moving down to finer levels. Scheduling and cancelling are O(1), and a
+    timer is moved at most ``levels - 1`` times.
+
+    Advancing skips the ticks of the finer levels while they are empty, so
+    catching up after a long pause costs about as much as advancing tick by
+    tick would have, and never more than visiting each timer ``levels`` times.
+
+    With the defaults, ticks are 10ms and the top level spans about 500 days;
+    later timers wait in the top level. Not thread safe.
+    """
+
+    def __init__(self, resolution=0.01, slots=256, levels=4, now=None):
+        self.resolution = resolution
+        self._size = slots
+        self._levels = [[set() for _ in xrange(slots)] for _ in xrange(levels)]
+        # the ticks spanned by one slot of each level
+        self._spans = [slots ** level for level in xrange(levels)]
+        # the number of timers in each level
+        self._counts = [0] * levels
+        now = time.time() if now is None else now
+        # the last tick that has been expired
+        self._tick = int(now / resolution)
+        self._count = 0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, deadline, payload):
+        """Schedule payload to expire at deadline, in seconds since the epoch."""
+        tick = max(int(math.ceil(deadline / self.resolution)), self._tick + 1)
+        timer = Timer(tick, (deadline, next(self._seq)), payload, None)
+        self._place(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer; returns False if it had already expired or been cancelled."""
+        if timer.slot is None:
+            return False
+        timer.slot.discard(timer)
+        timer.slot = None
+        self._counts[timer.level] -= 1
+        self._count -= 1
+        return True
+
+    def _place(self, timer):
+        delta = timer.tick - self._tick
+        spans = self._spans
+        level = 0
+        while level < len(spans) - 1 and delta >= spans[level + 1]:
+            level += 1
+        slot = self._levels[level][(timer.tick // spans[level]) % self._size]
+        slot.add(timer)
+        timer.slot = slot
+        timer.level = level
+        self._counts[level] += 1
+
+    def advance(self, now):
+        """Expire the timers due by now, returning their payloads in deadline
+        order; timers with the same deadline expire in the order scheduled."""
+        target = int(now / self.resolution)
+        if target <= self._tick:
+            return []
+        expired = []
+        levels = self._levels
+        spans = self._spans
+        counts = self._counts
+        size = self._size
+        while self._tick < target:
+            # with the levels below it empty, nothing happens before the next
+            # tick at which the first level holding timers cascades.
+            level = 0
+            while level < len(levels) and not counts[level]:
+                level += 1
+            if level == len(levels):
+                self._tick = target
+                break
+            if level:
+                tick = min(target, (self._tick // spans[level] + 1) * spans[level])
+            else:
+                tick = self._tick + 1
+            self._tick = tick
+            # at the end of a revolution, cascade the coarser levels, coarsest first.
+            for level in xrange(len(levels) - 1, 0, -1):
+                if tick % spans[level]:
+                    continue
+                slot = levels[level][(tick // spans[level]) % size]
+                if slot:
+                    cascaded = list(slot)
+                    slot.clear()
+                    counts[level] -= len(cascaded)
+                    for timer in cascaded:
+                        self._place(timer)
+            slot = levels[0][tick % size]
+            if slot:
+                due = [timer for timer in slot if timer.tick <= tick]
+                for timer in due:
+                    slot.discard(timer)
+                    timer.slot = None
+                counts[0] -= len(due)
+                expired.extend(due)
+        self._count -= len(expired)
+        return _expired(expired)
+
+
+class WheelTimer(object):
+    """Advances a timing wheel from a daemon thread, and calls ``expire``
+    with the payloads of each batch of expired timers, in order, on a second
+    daemon thread, so slow expiry does not hold back the wheel. The threads
+    run while there is work for them.
+    """
+
+    def __init__(self, expire, wheel=None, name="voom-timer"):
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self.name = name
+        self._expire = expire
+        self._lock = threading.Lock()
+        self._thread = None
+        # batches of expired payloads waiting for the expiring thread
+        self._batches = collections.deque()
+        self._expiring = None
+        self._stopped = False
+
+    def schedule(self, deadline, payload):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            return self.wheel.schedule(deadline, payload)
+
+    def cancel(self, timer):
+        with self._lock:
+            return self.wheel.cancel(timer)
+
+    def stop(self):
+        self._stopped = True
+        for thread in (self._thread, self._expiring):
+            if thread is not None:
+                thread.join()
+
+    def _run(self, sleep=time.sleep, now=time.time):
+        while not self._stopped:
+            sleep(self.wheel.resolution)
+            with self._lock:
+                payloads = self.wheel.advance(now())
+                if payloads:
+                    self._batches.append(payloads)
+                    if self._expiring is None:
+                        self._expiring = threading.Thread(target=self._expire_batches,
+                                                          name=self.name + "-expire")
+                        self._expiring.daemon = True
+                        self._expiring.start()
+                elif not self.wheel:
+                    self._thread = None
+                    return
+
+    def _expire_batches(self):
+        while True:
+            with self._lock:
+                if not self._batches:
+                    self._expiring = None
+                    return
+                payloads = self._batches.popleft()
+            try:
+                self._expire(payloads)
+            except Exception:
+                LOG.exception("failed to expire %d timers", len(payloads))
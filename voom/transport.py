@@ -0,0 +1,296 @@
+"""Bridge buses across processes on one host.
+
+A :class:`LocalBroker` listens on a Unix domain socket and relays every
+frame it receives to all of its other connections. A :class:`BusBridge`
+connects a bus to the broker: messages of the bridged types published on
+the bus are sent to the broker, and messages received from it are
+published on the bus.
+
+>>> broker = LocalBroker("/tmp/voom.sock")         # once per host
+>>> bridge = BusBridge(bus, "/tmp/voom.sock", [CacheInvalidated])
+
+Outbound messages are batched: whatever accumulates while a frame is being
+sent goes out in the next frame. A frame is a length-prefixed pickle of
+the list of message bodies, so the classes of Event subclasses (which
+pickle as their class and field values) are written once per frame.
+
+Frames are unpickled, so anyone who can connect to the broker can run code
+in every bridged process. The socket is only accessible to its owner;
+bridge processes running as other users need a socket in a directory
+they share, and must trust each other.
+"""
+from logging import getLogger
+import cPickle as pickle
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+
+LOG = getLogger(__name__)
+
+_LENGTH = struct.Struct(">I")
+
+
+def encode_frame(bodies):
+    payload = pickle.dumps(list(bodies), pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def decode_frame(payload):
+    return pickle.loads(payload)
+
+
+def read_frame(sock):
+    """Returns the next frame's payload, or None when the connection closes."""
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    return _recv_exactly(sock, _LENGTH.unpack(header)[0])
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+class LocalBroker(object):
+    """A stand-in for a message broker: relays frames between the processes
+    connected to a Unix domain socket.
+
+    Each connection has its own writer, so a slow peer does not hold up the
+    others; one that falls more than ``max_pending`` frames behind is
+    disconnected.
+    """
+
+    def __init__(self, path, max_pending=1024):
+        self.path = path
+        self.max_pending = max_pending
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        # before listening, so no one connects while the umask's mode applies.
+        os.chmod(path, 0600)
+        self._server.listen(64)
+        self._lock = threading.Lock()
+        self._peers = []
+        self._closed = False
+        self._thread = _start(self._accept, "voom-broker")
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                break
+            peer = _Peer(conn, self.max_pending)
+            with self._lock:
+                self._peers.append(peer)
+            _start(self._relay, "voom-broker-peer", peer)
+
+    def _relay(self, peer):
+        try:
+            while True:
+                payload = read_frame(peer.conn)
+                if payload is None:
+                    break
+                frame = _LENGTH.pack(len(payload)) + payload
+                with self._lock:
+                    peers = [p for p in self._peers if p is not peer]
+                for other in peers:
+                    other.send(frame)
+        except socket.error:
+            pass
+        finally:
+            with self._lock:
+                if peer in self._peers:
+                    self._peers.remove(peer)
+            peer.close()
+
+    def close(self):
+        self._closed = True
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server.close()
+        with self._lock:
+            peers, self._peers = self._peers, []
+        for peer in peers:
+            peer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class _Peer(object):
+    """A broker connection: frames relayed to it are queued and written, one
+    at a time, by its own thread."""
+
+    def __init__(self, conn, max_pending):
+        self.conn = conn
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._frames = collections.deque()
+        self._closed = False
+        self._writer = _start(self._write_loop, "voom-broker-write")
+
+    def send(self, frame):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._frames) >= self.max_pending:
+                LOG.warning("disconnecting a peer %d frames behind", len(self._frames))
+                self._shutdown()
+                return
+            self._frames.append(frame)
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._frames and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                frame = self._frames.popleft()
+            try:
+                self.conn.sendall(frame)
+            except socket.error:
+                LOG.warning("failed to relay frame to a peer", exc_info=True)
+                with self._cond:
+                    self._shutdown()
+                return
+
+    def _shutdown(self):
+        # called holding the condition; the reader sees the connection close.
+        self._closed = True
+        self._frames.clear()
+        self._cond.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        with self._cond:
+            self._shutdown()
+        self.conn.close()
+
+
+class BusBridge(object):
+    """Connects a bus to a :class:`LocalBroker`.
+
+    :param bus: the local bus.
+    :param path: the broker's socket.
+    :param message_types: the types to send to other processes; messages of
+       any type received from the broker are published locally.
+    :param max_batch: the largest number of messages sent in one frame.
+    """
+
+    def __init__(self, bus, path, message_types=(), max_batch=1024):
+        self.bus = bus
+        self.max_batch = max_batch
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._cond = threading.Condition()
+        self._outbound = collections.deque()
+        self._sending = False
+        self._closed = False
+        # ids of the bodies being published from the broker, so they are not echoed back.
+        self._inbound = set()
+        self.message_types = tuple(message_types)
+        for message_type in self.message_types:
+            bus.subscribe(message_type, self.send)
+        self._sender = _start(self._send_loop, "voom-bridge-send")
+        self._receiver = _start(self._receive_loop, "voom-bridge-receive")
+
+    def send(self, body):
+        """Queue a message for the other processes; this is the bridge's handler."""
+        if id(body) in self._inbound:
+            return
+        with self._cond:
+            self._outbound.append(body)
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been written to the socket."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while (self._outbound or self._sending) and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return not (self._outbound or self._sending)
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while not self._outbound and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = [self._outbound.popleft()
+                         for _ in xrange(min(self.max_batch, len(self._outbound)))]
+                self._sending = True
+            try:
+                self._sock.sendall(encode_frame(batch))
+            except Exception:
+                LOG.exception("failed to send %d messages to the broker", len(batch))
+            finally:
+                with self._cond:
+                    self._sending = False
+                    self._cond.notify_all()
+
+    def _receive_loop(self):
+        while not self._closed:
+            try:
+                payload = read_frame(self._sock)
+            except socket.error:
+                payload = None
+            if payload is None:
+                break
+            try:
+                bodies = decode_frame(payload)
+            except Exception:
+                LOG.exception("failed to decode a frame from the broker")
+                continue
+            self._inbound.update(id(b) for b in bodies)
+            try:
+                self.bus.publish_many(bodies)
+            except Exception:
+                LOG.exception("failed to publish messages from the broker")
+            finally:
+                self._inbound.clear()
+
+    def close(self):
+        for message_type in self.message_types:
+            try:
+                self.bus.unsubscribe(message_type, self.send)
+            except ValueError:
+                pass
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+        self._sender.join()
+        self._receiver.join()
+
+
+def _start(target, name, *args):
+    t = threading.Thread(target=target, name=name, args=args)
+    t.daemon = True
+    t.start()
+    return t